@@ -1,18 +1,49 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+import time
+
+_INICIO_IMPORT = time.perf_counter()
+
+from flask import Flask, Response, g, has_request_context, render_template, request, redirect, url_for, session, flash, jsonify
+from markupsafe import Markup, escape
 import os
 import json
-import gspread
-from google.oauth2.service_account import Credentials
-from datetime import datetime
+import queue
+import threading
+import random
+import gzip
+import hashlib
+import hmac
+import csv
+import io
+import tempfile
+import re
+import sqlite3
+import unicodedata
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import click
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-import requests
 from collections import defaultdict
+from importlib.util import find_spec
+
+# gspread, google-auth, requests y openpyxl se importan recién al usarse:
+# el arranque (cold start en el plan gratuito) no paga por ellos.
+
+try:
+    import brotli  # opcional: si no está instalado solo se sirve gzip
+except ImportError:
+    brotli = None
+
+HAY_OPENPYXL = find_spec("openpyxl") is not None  # opcional: sin él /export/solicitudes solo da CSV
 
 # ===============================
 # WHATSAPP NOTIFICACIÓN
 # ===============================
 WHATSAPP_TOKEN = os.environ.get("WHATSAPP_TOKEN")
 WHATSAPP_PHONE_ID = os.environ.get("WHATSAPP_PHONE_ID")
+WHATSAPP_VERIFY_TOKEN = os.environ.get("WHATSAPP_VERIFY_TOKEN", "antamina-xylem-2026")
+WHATSAPP_APP_SECRET = os.environ.get("WHATSAPP_APP_SECRET", "")  # si está, se valida X-Hub-Signature-256
 
 # ✅ Destinatarios almacén (2 almaceneros)
 WHATSAPP_TOS = os.environ.get("WHATSAPP_TOS", "")  # JSON: ["519...","519..."] o 519...
@@ -28,7 +59,7 @@ def get_whatsapp_tos():
     raw = (os.environ.get("WHATSAPP_TOS") or "").strip()
 
     if not raw:
-        print("⚠️ WHATSAPP_TOS vacío en Render")
+        log_evento("whatsapp_tos_vacio")
         return []
 
     try:
@@ -44,9 +75,9 @@ def get_whatsapp_tos():
     return [raw.replace(" ", "")]
 
 
-def formatear_mensaje_whatsapp_solicitud(solicitante: str, items: list) -> str:
-    """Mensaje bonito: solicitante + items + cantidades + hora"""
-    ahora = datetime.now(ZoneInfo("America/Lima")).strftime("%d/%m/%Y %H:%M")
+def formatear_mensaje_whatsapp_solicitud(solicitante: str, items: list, hora: str = None, pie: bool = True) -> str:
+    """Mensaje bonito: solicitante + items + cantidades + hora (por defecto, ahora)"""
+    ahora = hora or datetime.now(ZoneInfo("America/Lima")).strftime("%d/%m/%Y %H:%M")
     solicitante = (solicitante or "").strip().upper()
 
     lineas = []
@@ -71,520 +102,3486 @@ def formatear_mensaje_whatsapp_solicitud(solicitante: str, items: list) -> str:
             else:
                 lineas.append(f"{i}. x{cant}")
 
-    lineas.append("")
-    lineas.append("✅ Ingresar a la bandeja para atender.")
+    if pie:
+        lineas.append("")
+        lineas.append("✅ Ingresar a la bandeja para atender.")
     return "\n".join(lineas)
 
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "xylem123")
 
-SPREADSHEET_ID = os.environ["SPREADSHEET_ID"]
-GOOGLE_CREDENTIALS = json.loads(os.environ["GOOGLE_CREDENTIALS"])
+# SPREADSHEET_ID y GOOGLE_CREDENTIALS se leen al abrir la primera conexión a Sheets
 
 
 # ===============================
-# GOOGLE SHEETS
+# MÉTRICAS (PROMETHEUS) Y LOGS JSON
 # ===============================
-def get_gsheet():
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ]
-    credentials = Credentials.from_service_account_info(GOOGLE_CREDENTIALS, scopes=scopes)
-    client = gspread.authorize(credentials)
-    return client.open_by_key(SPREADSHEET_ID)
-
-
-def get_ws(nombre):
-    sh = get_gsheet()
-    return sh.worksheet(nombre)
+# Registro en memoria por proceso: con varios workers de gunicorn cada
+# scrape de /metrics ve el worker que atendió (etiqueta "pid").
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+
+class Metricas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tipos = {}         # nombre -> (tipo, ayuda)
+        self._contadores = {}    # (nombre, etiquetas) -> valor
+        self._histogramas = {}   # (nombre, etiquetas) -> [cubetas..., suma, cantidad]
+
+    def describir(self, nombre, tipo, ayuda):
+        self._tipos[nombre] = (tipo, ayuda)
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def fijar(self, nombre, valor, **etiquetas):
+        with self._lock:
+            self._contadores[(nombre, tuple(sorted(etiquetas.items())))] = valor
+
+    def observar(self, nombre, segundos, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            h = self._histogramas.get(clave)
+            if h is None:
+                h = self._histogramas[clave] = [0] * len(BUCKETS_SEGUNDOS) + [0.0, 0]
+            for i, limite in enumerate(BUCKETS_SEGUNDOS):
+                if segundos <= limite:
+                    h[i] += 1
+            h[-2] += segundos
+            h[-1] += 1
+
+    def texto(self):
+        pid = str(os.getpid())
+
+        def escapar(valor):
+            return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def etiquetas(pares, extra=()):
+            todas = [("pid", pid), *pares, *extra]
+            return "{" + ",".join(f'{k}="{escapar(v)}"' for k, v in todas) + "}"
+
+        lineas = []
+        with self._lock:
+            series = defaultdict(list)
+            for (nombre, pares), valor in self._contadores.items():
+                series[nombre].append(f"{nombre}{etiquetas(pares)} {valor}")
+            for (nombre, pares), h in self._histogramas.items():
+                for i, limite in enumerate(BUCKETS_SEGUNDOS):
+                    series[nombre].append(f"{nombre}_bucket{etiquetas(pares, [('le', limite)])} {h[i]}")
+                series[nombre].append(f"{nombre}_bucket{etiquetas(pares, [('le', '+Inf')])} {h[-1]}")
+                series[nombre].append(f"{nombre}_sum{etiquetas(pares)} {h[-2]:.6f}")
+                series[nombre].append(f"{nombre}_count{etiquetas(pares)} {h[-1]}")
+
+        for nombre in sorted(series):
+            tipo, ayuda = self._tipos.get(nombre, ("untyped", ""))
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            lineas.extend(sorted(series[nombre]))
+        return "\n".join(lineas) + "\n"
+
+
+METRICAS = Metricas()
+METRICAS.describir("http_request_duration_seconds", "histogram", "Latencia por ruta")
+METRICAS.describir("sheets_llamada_segundos", "histogram", "Duración de cada llamada a Sheets por hoja y operación")
+METRICAS.describir("sheets_llamadas_total", "counter", "Llamadas a Sheets por hoja, operación y resultado")
+METRICAS.describir("sheets_lecturas_fusionadas_total", "counter", "Lecturas que reutilizaron una lectura idéntica en curso")
+METRICAS.describir("sheets_espera_cuota_segundos", "histogram", "Espera por cuota/concurrencia antes de llamar a Sheets")
+METRICAS.describir("whatsapp_envio_segundos", "histogram", "Latencia de cada envío a la API de WhatsApp")
+METRICAS.describir("whatsapp_solicitudes_total", "counter", "Solicitudes notificadas por WhatsApp (inmediato o en resumen)")
+METRICAS.describir("whatsapp_envios_total", "counter", "Envíos WhatsApp por resultado (enviado, reintento, muerto)")
+METRICAS.describir("arranque_segundos", "gauge", "Tiempo de arranque del worker por fase (import, snapshot, primera petición)")
+METRICAS.describir("cache_consultas_total", "counter", "Consultas a caches en memoria (hit, miss, vencido)")
+METRICAS.describir("replica_sync_total", "counter", "Sincronizaciones de la réplica de Solicitudes por tipo")
+METRICAS.describir("bandeja_stream_conexiones_total", "counter", "Conexiones abiertas a /bandeja/stream")
+METRICAS.describir("webhook_eventos_total", "counter", "Eventos del webhook de WhatsApp por tipo")
+METRICAS.describir("stock_escrituras_total", "counter", "Códigos con STOCK actualizado en Catalogo por el libro de stock")
+METRICAS.describir("solicitudes_archivadas_total", "counter", "Filas movidas de Solicitudes a las hojas de archivo")
+
+
+def log_evento(evento, **campos):
+    """Log estructurado (1 línea JSON) con el request id si hay petición en curso."""
+    registro = {"ts": datetime.now(ZoneInfo("America/Lima")).isoformat(timespec="milliseconds"), "evento": evento}
+    if has_request_context():
+        registro["request_id"] = getattr(g, "request_id", None)
+    registro.update(campos)
+    print(json.dumps(registro, ensure_ascii=False, default=str), flush=True)
+
+
+@app.before_request
+def iniciar_medicion():
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    g.t_inicio = time.perf_counter()
+
+
+@app.after_request
+def registrar_medicion(resp):
+    inicio = getattr(g, "t_inicio", None)
+    if inicio is not None:
+        duracion = time.perf_counter() - inicio
+        ruta = request.url_rule.rule if request.url_rule else "desconocida"
+        METRICAS.observar(
+            "http_request_duration_seconds", duracion,
+            ruta=ruta, metodo=request.method, status=resp.status_code,
+        )
+        if ruta != "/metrics":
+            log_evento("http", ruta=ruta, metodo=request.method, status=resp.status_code,
+                       ms=round(duracion * 1000, 1))
+        if _arranque["primera"] != os.getpid():
+            _arranque["primera"] = os.getpid()
+            METRICAS.fijar("arranque_segundos", duracion, fase="primera_peticion")
+            log_evento("primera_peticion", ruta=ruta, ms=round(duracion * 1000, 1))
+    resp.headers["X-Request-ID"] = getattr(g, "request_id", "")
+    return resp
 
 
 # ===============================
-# CATALOGO (BUSQUEDA)
+# GOOGLE SHEETS
 # ===============================
-def buscar_en_catalogo(tipo, descripcion):
-    """
-    Busca en hoja Catalogo según tipo + descripcion
-    Devuelve: codigo_sap, codigo_barras, um
-    """
-    wsCat = get_ws("Catalogo")
-    filas = wsCat.get_all_records()
+# Un solo cliente autorizado por proceso (cada worker de gunicorn tiene el suyo).
+# AuthorizedSession reutiliza el pool de conexiones HTTP y solo refresca el
+# token cuando expira. Los Worksheet se cachean por nombre.
+SHEETS_POOL_SIZE = int(os.environ.get("SHEETS_POOL_SIZE", "10"))
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", "30"))
 
-    tipo = str(tipo).strip().upper()
-    descripcion = str(descripcion).strip().upper()
+# ===============================
+# PLANIFICADOR DE LLAMADAS A SHEETS
+# ===============================
+# Toda llamada a Sheets pasa por aquí (get_gsheet/get_ws devuelven objetos
+# envueltos). Cubeta de tokens por carril (lectura/escritura) con la cuota
+# por minuto repartida entre los workers, lecturas idénticas simultáneas
+# fusionadas en una sola, reintentos con backoff exponencial + jitter, y
+# prioridad de las escrituras sobre las lecturas cuando compiten por un hueco.
+SHEETS_CUOTA_LECTURA = int(os.environ.get("SHEETS_CUOTA_LECTURA", "60"))    # por minuto
+SHEETS_CUOTA_ESCRITURA = int(os.environ.get("SHEETS_CUOTA_ESCRITURA", "60"))  # por minuto
+SHEETS_WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+SHEETS_CONCURRENCIA = int(os.environ.get("SHEETS_CONCURRENCIA", "4"))      # llamadas en curso por worker
+SHEETS_REINTENTOS = int(os.environ.get("SHEETS_REINTENTOS", "5"))
+SHEETS_BACKOFF_BASE = float(os.environ.get("SHEETS_BACKOFF_BASE", "1"))
+SHEETS_BACKOFF_MAX = float(os.environ.get("SHEETS_BACKOFF_MAX", "32"))
+
+METODOS_LECTURA = {
+    "get", "get_values", "get_all_values", "get_all_records", "batch_get", "values_batch_get",
+    "row_values", "col_values", "acell", "cell", "find", "findall", "worksheet", "worksheets",
+    "fetch_sheet_metadata", "open_by_key",
+}
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+class SheetsSaturado(Exception):
+    pass
+
+
+class PlanificadorSheets:
+    def __init__(self, cuota_lectura, cuota_escritura, workers, concurrencia):
+        self._cond = threading.Condition()
+        self._capacidad = {
+            "lectura": max(1.0, cuota_lectura / max(workers, 1)),
+            "escritura": max(1.0, cuota_escritura / max(workers, 1)),
+        }
+        self._tokens = dict(self._capacidad)
+        self._repuesto = time.monotonic()
+        self._esperando = {"lectura": 0, "escritura": 0}
+        self._en_curso = 0
+        self._concurrencia = concurrencia
+        self._en_vuelo = {}  # lecturas en curso: clave -> [evento, resultado, error]
+
+    def _reponer(self):
+        ahora = time.monotonic()
+        transcurrido = ahora - self._repuesto
+        self._repuesto = ahora
+        for carril, capacidad in self._capacidad.items():
+            self._tokens[carril] = min(capacidad, self._tokens[carril] + transcurrido * capacidad / 60.0)
+
+    def _puede_pasar(self, carril):
+        if self._en_curso >= self._concurrencia or self._tokens[carril] < 1:
+            return False
+        # Una lectura cede el hueco si hay una escritura esperando que sí podría pasar
+        if carril == "lectura" and self._esperando["escritura"] and self._tokens["escritura"] >= 1:
+            return False
+        return True
+
+    def _adquirir(self, carril):
+        with self._cond:
+            self._esperando[carril] += 1
+            try:
+                while True:
+                    self._reponer()
+                    if self._puede_pasar(carril):
+                        self._tokens[carril] -= 1
+                        self._en_curso += 1
+                        return
+                    falta = max(0.0, 1 - self._tokens[carril]) * 60.0 / self._capacidad[carril]
+                    self._cond.wait(timeout=min(max(falta, 0.05), 1.0))
+            finally:
+                self._esperando[carril] -= 1
+
+    def _liberar(self):
+        with self._cond:
+            self._en_curso -= 1
+            self._cond.notify_all()
+
+    def llamar(self, carril, hoja, metodo, fn, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if carril != "lectura":
+            return self._ejecutar(carril, hoja, metodo, fn, args, kwargs)
+
+        # Lecturas idénticas en curso: esperamos el resultado de la primera
+        clave = (hoja, metodo, repr(args), repr(sorted(kwargs.items())))
+        with self._cond:
+            vuelo = self._en_vuelo.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = [threading.Event(), None, None]
+                self._en_vuelo[clave] = vuelo
+
+        if not lider:
+            METRICAS.contar("sheets_lecturas_fusionadas_total", hoja=hoja, operacion=metodo)
+            vuelo[0].wait()
+            if vuelo[2] is not None:
+                raise vuelo[2]
+            return vuelo[1]
 
-    for fila in filas:
-        tipo_fila = str(fila.get("TIPO", "")).strip().upper()
-        desc_fila = str(fila.get("DESCRIPCION", "")).strip().upper()
+        try:
+            vuelo[1] = self._ejecutar(carril, hoja, metodo, fn, args, kwargs)
+            return vuelo[1]
+        except Exception as e:
+            vuelo[2] = e
+            raise
+        finally:
+            with self._cond:
+                self._en_vuelo.pop(clave, None)
+            vuelo[0].set()
+
+    def _ejecutar(self, carril, hoja, metodo, fn, args, kwargs):
+        intento = 0
+        while True:
+            espera = time.perf_counter()
+            self._adquirir(carril)
+            inicio = time.perf_counter()
+            METRICAS.observar("sheets_espera_cuota_segundos", inicio - espera, carril=carril)
+            resultado = "error"
+            try:
+                respuesta = fn(*args, **kwargs)
+                resultado = "ok"
+                return respuesta
+            except _api_error() as e:
+                # Una escritura con 5xx pudo haberse aplicado (p.ej. append_rows):
+                # solo el 429 garantiza que no, así que solo ese se reintenta.
+                codigo = getattr(e, "code", None)
+                if codigo not in CODIGOS_REINTENTABLES or (carril != "lectura" and codigo != 429):
+                    raise
+                error = e
+            except _errores_red() as e:
+                if carril != "lectura":
+                    raise
+                codigo = None
+                error = e
+            finally:
+                self._liberar()
+                METRICAS.observar("sheets_llamada_segundos", time.perf_counter() - inicio, hoja=hoja, operacion=metodo)
+                METRICAS.contar("sheets_llamadas_total", hoja=hoja, operacion=metodo, resultado=resultado)
 
-        if tipo_fila == tipo and desc_fila == descripcion:
-            codigo_sap = str(fila.get("CODIGO", "")).strip()
+            intento += 1
+            if intento > SHEETS_REINTENTOS:
+                if codigo == 429:
+                    raise SheetsSaturado(
+                        "Google Sheets está saturado en este momento; intente de nuevo en unos segundos"
+                    ) from error
+                raise error
 
-            um = str(fila.get("U.M", "")).strip() or str(fila.get("UM", "")).strip()
+            espera = min(SHEETS_BACKOFF_BASE * 2 ** (intento - 1), SHEETS_BACKOFF_MAX)
+            espera = random.uniform(espera / 2, espera)
+            log_evento("sheets_reintento", hoja=hoja, operacion=metodo, codigo=codigo,
+                       error=str(error)[:200], intento=intento, espera_seg=round(espera, 2))
+            time.sleep(espera)
 
-            # CODIGO_BARRAS puede estar guardado o lo generamos automático
-            codigo_barras = str(fila.get("CODIGO_BARRAS", "")).strip()
 
-            if not codigo_barras and codigo_sap:
-                # Formato Code39 para lectura con Free 3 of 9
-                codigo_barras = f"*{codigo_sap}*"
+PLANIFICADOR = PlanificadorSheets(
+    SHEETS_CUOTA_LECTURA, SHEETS_CUOTA_ESCRITURA, SHEETS_WORKERS, SHEETS_CONCURRENCIA
+)
 
-            return codigo_sap, codigo_barras, um
 
-    return "", "", ""
+class SheetsPlanificado:
+    """Envuelve un Spreadsheet o Worksheet: cada método pasa por el PLANIFICADOR."""
 
+    def __init__(self, objeto, hoja="*"):
+        self._objeto = objeto
+        self._hoja = hoja
 
-# ===============================
-# WHATSAPP
-# ===============================
+    def __getattr__(self, nombre):
+        attr = getattr(self._objeto, nombre)
+        if nombre.startswith("_") or not callable(attr):
+            return attr
 
-def enviar_whatsapp_solicitud(solicitante: str, items: list):
-    """Notificación WhatsApp: solicitante + ítems.
-    Destinatarios salen de Render (WHATSAPP_TOS).
-    """
-    if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_ID:
-        print("⚠️ WhatsApp no configurado")
-        return
+        carril = "lectura" if nombre in METODOS_LECTURA else "escritura"
 
-    tos = get_whatsapp_tos()
-    if not tos:
-        print("⚠️ Lista de destinatarios WhatsApp vacía")
-        return
+        def llamada(*args, **kwargs):
+            return PLANIFICADOR.llamar(carril, self._hoja, nombre, attr, args, kwargs)
 
-    mensaje = formatear_mensaje_whatsapp_solicitud(solicitante, items)
+        return llamada
 
-    url = f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
 
-    for numero in tos:
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": numero,
-            "type": "text",
-            "text": {"body": mensaje}
-        }
+_gs_lock = threading.RLock()
+_gs_estado = {"pid": None, "sheet": None, "hojas": {}}
 
-        try:
-            r = requests.post(url, json=payload, headers=headers, timeout=20)
-            print(f"✅ WhatsApp enviado a {numero}: ", r.status_code, r.text)
-        except Exception as e:
-            print(f"❌ Error WhatsApp ({numero}):", e)
 
+def _api_error():
+    """gspread.exceptions.APIError (solo se importa gspread si hubo una excepción)."""
+    from gspread.exceptions import APIError
+    return APIError
 
 
-def get_usuario(codigo):
-    ws = get_ws("Usuarios")
-    filas = ws.get_all_records()
+def _errores_red():
+    import requests
+    return (requests.ConnectionError, requests.Timeout)
 
-    for fila in filas:
-        if str(fila.get("CODIGO", "")).strip() == str(codigo).strip():
-            return {
-                "codigo": str(fila.get("CODIGO", "")).strip(),
-                "nombre": str(fila.get("NOMBRE COMPLETO", "")).strip(),
-                "cargo": str(fila.get("CARGO", "")).strip(),
-                "area": str(fila.get("AREA", "")).strip(),
-                "rol": str(fila.get("ROL", "")).strip(),
-            }
-    return None
 
-# ===============================
-# RUTAS PRINCIPALES
-# ===============================
-@app.route("/", methods=["GET"])
-def root():
-    return redirect(url_for("login"))
+def _crear_gsheet():
+    import gspread
+    from google.oauth2.service_account import Credentials
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
 
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive",
+    ]
+    credentials = Credentials.from_service_account_info(json.loads(os.environ["GOOGLE_CREDENTIALS"]), scopes=scopes)
 
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
-        # --- PERSONAL ---
-        codigo_personal = request.form.get("codigo_personal", "").strip()
-        nombre_personal = request.form.get("nombre_personal", "").strip()
+    http_session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=SHEETS_POOL_SIZE, pool_maxsize=SHEETS_POOL_SIZE)
+    http_session.mount("https://", adapter)
 
-        # --- ALMACENERO ---
-        almacenero = request.form.get("almacenero", "").strip()
-        password = request.form.get("password", "").strip()
+    client = gspread.authorize(credentials, session=http_session)
+    client.set_timeout(SHEETS_TIMEOUT)
+    return client.open_by_key(os.environ["SPREADSHEET_ID"])
 
-        # ========= VALIDACIÓN =========
 
-        # Almacenero
-        if almacenero:
-            if almacenero == "EDWIN ROMERO" and password == "6982":
-                session["rol"] = "ALMACEN"
-                session["nombre"] = almacenero
-                return redirect(url_for("inicio"))
+def get_gsheet():
+    # Si el proceso hizo fork (gunicorn --preload) no compartimos sockets con el padre
+    pid = os.getpid()
+    sh = _gs_estado["sheet"]
+    if sh is not None and _gs_estado["pid"] == pid:
+        return sh
 
-            if almacenero == "EDGAR GARCIA" and password == "1234":
-                session["rol"] = "ALMACEN"
-                session["nombre"] = almacenero
-                return redirect(url_for("inicio"))
+    with _gs_lock:
+        if _gs_estado["sheet"] is None or _gs_estado["pid"] != pid:
+            sh = PLANIFICADOR.llamar("lectura", "*", "open_by_key", _crear_gsheet)
+            _gs_estado["sheet"] = SheetsPlanificado(sh)
+            _gs_estado["hojas"] = {}
+            _gs_estado["pid"] = pid
+        return _gs_estado["sheet"]
 
-            return render_template("login.html", error="Contraseña incorrecta")
 
-        # Personal (con validación desde sheet Usuarios por CODIGO)
-        if codigo_personal:
-            usuario = get_usuario(codigo_personal)
-            if usuario:
-                session["rol"] = "PERSONAL"
-                session["nombre"] = usuario["nombre"]
-                return redirect(url_for("inicio"))
-            return render_template("login.html", error="Código no registrado")
+def get_ws(nombre):
+    sh = get_gsheet()
+    ws = _gs_estado["hojas"].get(nombre)
+    if ws is not None:
+        return ws
 
-        # Login por nombre sin código
-        if nombre_personal:
-            session["rol"] = "PERSONAL"
-            session["nombre"] = nombre_personal
-            return redirect(url_for("inicio"))
+    with _gs_lock:
+        ws = _gs_estado["hojas"].get(nombre)
+        if ws is None:
+            ws = SheetsPlanificado(sh.worksheet(nombre), nombre)
+            _gs_estado["hojas"][nombre] = ws
+        return ws
 
-        return render_template("login.html", error="Complete los datos de ingreso")
 
-    return render_template("login.html")
+def usar_spreadsheet(sh):
+    """
+    Reemplaza el Spreadsheet de Google por otro objeto compatible (p.ej. el
+    fake de bench/). Descarta hojas y caches en memoria del backend anterior.
+    """
+    with _gs_lock:
+        _gs_estado["sheet"] = SheetsPlanificado(sh)
+        _gs_estado["hojas"] = {}
+        _gs_estado["pid"] = os.getpid()
 
+    for cache in (CATALOGO, USUARIOS):
+        cache.descartar()
 
-@app.route("/inicio")
-def inicio():
-    if "nombre" not in session:
-        return redirect(url_for("login"))
 
-    # 🔑 ALMACENERO → BANDEJA
-    if session.get("rol") == "ALMACEN":
-        return redirect(url_for("bandeja"))
+# ===============================
+# BASE LOCAL (SQLITE)
+# ===============================
+# Archivo compartido por todos los workers del mismo servidor.
+# Cada hilo abre su propia conexión; las transacciones usan BEGIN IMMEDIATE.
+# Con workers gevent cada greenlet es un "hilo": ninguna transacción debe
+# esperar red (Sheets/WhatsApp) mientras tiene el lock de escritura.
+LOCAL_DB = os.environ.get("LOCAL_DB", "almacen.sqlite3")
+
+_ESQUEMA_SQL = """
+CREATE TABLE IF NOT EXISTS outbox_whatsapp (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    id_solicitud TEXT,
+    destinatario TEXT NOT NULL,
+    mensaje TEXT NOT NULL,
+    estado TEXT NOT NULL DEFAULT 'PENDIENTE',  -- PENDIENTE | ENVIANDO | ENVIADO | MUERTO
+    intentos INTEGER NOT NULL DEFAULT 0,
+    proximo_intento REAL NOT NULL,
+    ultimo_error TEXT,
+    message_id TEXT,
+    creado REAL NOT NULL,
+    actualizado REAL
+);
+CREATE INDEX IF NOT EXISTS ix_outbox_estado ON outbox_whatsapp(estado, proximo_intento);
+
+CREATE TABLE IF NOT EXISTS whatsapp_resumen (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    id_solicitud TEXT,
+    solicitante TEXT,
+    hora TEXT NOT NULL,        -- dd/mm/YYYY HH:MM de la solicitud
+    items TEXT NOT NULL,       -- JSON: tipo, descripcion, cantidad
+    n_items INTEGER NOT NULL,
+    creado REAL NOT NULL,
+    enviado REAL               -- NULL = esperando el próximo resumen
+);
+CREATE INDEX IF NOT EXISTS ix_whatsapp_resumen_pendiente ON whatsapp_resumen(enviado);
+
+CREATE TABLE IF NOT EXISTS solicitudes (
+    fila INTEGER PRIMARY KEY,  -- fila real en la hoja Solicitudes
+    id_solicitud TEXT NOT NULL,
+    fecha TEXT,
+    fecha_iso TEXT,            -- FECHA como 'YYYY-MM-DD HH:MM' (para filtrar/ordenar)
+    solicitante TEXT,
+    tipo TEXT,
+    codigo_sap TEXT,
+    descripcion TEXT,
+    um TEXT,
+    cantidad TEXT,
+    estado TEXT,
+    almacenero TEXT,
+    vale INTEGER,              -- K: número de vale (NULL si no tiene)
+    fecha_vale TEXT            -- L: dd/mm/YYYY HH:MM del vale
+);
+CREATE INDEX IF NOT EXISTS ix_solicitudes_id ON solicitudes(id_solicitud);
+CREATE INDEX IF NOT EXISTS ix_solicitudes_estado ON solicitudes(estado, id_solicitud);
+
+CREATE TABLE IF NOT EXISTS webhook_eventos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cuerpo BLOB NOT NULL,      -- POST de Meta tal cual llegó
+    recibido REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS whatsapp_estados (
+    message_id TEXT PRIMARY KEY,
+    id_solicitud TEXT,
+    destinatario TEXT,
+    estado TEXT NOT NULL,      -- aceptado | sent | delivered | read | failed
+    enviado REAL,              -- timestamps que informa Meta
+    entregado REAL,
+    leido REAL,
+    fallido REAL,
+    error TEXT,
+    actualizado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_whatsapp_estados_solicitud ON whatsapp_estados(id_solicitud);
+
+CREATE TABLE IF NOT EXISTS whatsapp_solicitudes (
+    outbox_id INTEGER NOT NULL,    -- envío de un resumen (un mensaje, varias solicitudes)
+    id_solicitud TEXT NOT NULL,
+    message_id TEXT,               -- lo completa el envío; enlaza con whatsapp_estados
+    creado REAL NOT NULL,
+    PRIMARY KEY (outbox_id, id_solicitud)
+);
+CREATE INDEX IF NOT EXISTS ix_whatsapp_solicitudes_id ON whatsapp_solicitudes(id_solicitud);
+
+CREATE TABLE IF NOT EXISTS replica_meta (
+    clave TEXT PRIMARY KEY,
+    valor REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS snapshots_hoja (
+    hoja TEXT PRIMARY KEY,
+    revision TEXT NOT NULL,    -- sha256 de los registros leídos de la hoja
+    marca TEXT,                -- JSON de CacheHoja.marca al leerla
+    registros TEXT NOT NULL,   -- JSON de get_all_records
+    guardado REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS secuencias (
+    nombre TEXT PRIMARY KEY,
+    valor INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS idempotencia (
+    clave TEXT PRIMARY KEY,    -- idempotency_key del formulario
+    id_solicitud TEXT NOT NULL,
+    estado TEXT NOT NULL,      -- EN_CURSO | HECHO
+    creado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_idempotencia_creado ON idempotencia(creado);
+
+CREATE TABLE IF NOT EXISTS solicitudes_archivo (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hoja TEXT NOT NULL,        -- Solicitudes_YYYY_MM donde quedó la fila
+    id_solicitud TEXT NOT NULL,
+    fecha TEXT,
+    fecha_iso TEXT,
+    solicitante TEXT,
+    tipo TEXT,
+    codigo_sap TEXT,
+    descripcion TEXT,
+    um TEXT,
+    cantidad TEXT,
+    estado TEXT,
+    almacenero TEXT,
+    vale INTEGER,
+    fecha_vale TEXT,
+    archivado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_archivo_id ON solicitudes_archivo(id_solicitud);
+CREATE INDEX IF NOT EXISTS ix_archivo_fecha ON solicitudes_archivo(fecha_iso);
+
+CREATE TABLE IF NOT EXISTS movimientos_stock (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    codigo TEXT NOT NULL,
+    tipo TEXT NOT NULL,        -- RESERVA | LIBERA | SALIDA (negativa = salida revertida)
+    cantidad INTEGER NOT NULL,
+    id_solicitud TEXT,
+    renglon INTEGER,           -- posición de la fila dentro de la solicitud (0, 1, ...)
+    creado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_movimientos_solicitud ON movimientos_stock(id_solicitud, tipo);
+
+CREATE TABLE IF NOT EXISTS resumen_items (
+    clave TEXT PRIMARY KEY,    -- CODIGO_SAP (o la descripción si no tiene)
+    codigo_sap TEXT,
+    descripcion TEXT,
+    tipo TEXT,
+    um TEXT,
+    solicitado INTEGER NOT NULL DEFAULT 0,
+    entregado INTEGER NOT NULL DEFAULT 0,   -- filas en ATENDIDO
+    lineas INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_resumen_items_solicitado ON resumen_items(solicitado);
+
+CREATE TABLE IF NOT EXISTS resumen_solicitantes (
+    solicitante TEXT PRIMARY KEY,
+    area TEXT NOT NULL,
+    solicitado INTEGER NOT NULL DEFAULT 0,
+    entregado INTEGER NOT NULL DEFAULT 0,
+    solicitudes INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS resumen_dias (
+    dia TEXT PRIMARY KEY,      -- YYYY-MM-DD de la FECHA de la solicitud
+    solicitudes INTEGER NOT NULL DEFAULT 0,
+    lineas INTEGER NOT NULL DEFAULT 0,
+    unidades INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS eventos_bandeja (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tipo TEXT NOT NULL,        -- nueva | estado | recarga
+    id_solicitud TEXT,
+    creado REAL NOT NULL
+);
+"""
+
+# Columnas agregadas a tablas que ya existían: las bases locales creadas
+# antes las reciben con ALTER TABLE (y luego sus índices).
+_COLUMNAS_AGREGADAS = [
+    ("solicitudes", "vale", "INTEGER"),
+    ("solicitudes", "fecha_vale", "TEXT"),
+    ("solicitudes_archivo", "vale", "INTEGER"),
+    ("solicitudes_archivo", "fecha_vale", "TEXT"),
+    ("movimientos_stock", "renglon", "INTEGER"),
+]
+_INDICES_AGREGADOS = """
+CREATE INDEX IF NOT EXISTS ix_solicitudes_vale ON solicitudes(vale);
+CREATE INDEX IF NOT EXISTS ix_archivo_vale ON solicitudes_archivo(vale);
+"""
+
+_db_local = threading.local()
+_db_esquema = {"pid": None}
+
+
+def _migrar_columnas(con):
+    for tabla, columna, tipo in _COLUMNAS_AGREGADAS:
+        existentes = {f["name"] for f in con.execute(f"PRAGMA table_info({tabla})")}
+        if columna not in existentes:
+            con.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}")
+    con.executescript(_INDICES_AGREGADOS)
+
+
+def get_db():
+    pid = os.getpid()
+    con = getattr(_db_local, "con", None)
+    if con is not None and getattr(_db_local, "pid", None) == pid:
+        return con
+
+    con = sqlite3.connect(LOCAL_DB, timeout=30, isolation_level=None, check_same_thread=False)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+
+    if _db_esquema["pid"] != pid:
+        con.executescript(_ESQUEMA_SQL)
+        _migrar_columnas(con)
+        _db_esquema["pid"] = pid
+
+    _db_local.con = con
+    _db_local.pid = pid
+    return con
+
+
+@contextmanager
+def transaccion():
+    con = get_db()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con
+        con.execute("COMMIT")
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
 
-    # 👷 PERSONAL → INICIO NORMAL
-    return render_template("inicio.html")
 
+# ===============================
+# CACHE DE HOJAS (SNAPSHOT EN MEMORIA)
+# ===============================
+class CacheHoja:
+    """
+    Snapshot en memoria de una hoja, con los índices que arma `construir`.
+    Se recarga al vencer el TTL o al invalidarlo. Mientras un hilo recarga,
+    los demás siguen usando el snapshot anterior.
 
-@app.route("/solicitar")
-def solicitar():
-    if "nombre" not in session:
-        return redirect(url_for("login"))
-    return render_template("solicitar.html")
+    Cada lectura se guarda también en SQLite (snapshots_hoja) con su revisión:
+    tras un reinicio la primera consulta usa la copia local y un hilo la
+    actualiza desde Google en segundo plano.
+    """
 
+    def __init__(self, nombre_hoja, construir, ttl, marca=None):
+        self.nombre_hoja = nombre_hoja
+        self.construir = construir  # registros (get_all_records) -> dict con índices
+        self.ttl = ttl
+        self.marca = marca          # opcional: se evalúa antes de leer y va a construir()
+        self._lock = threading.Lock()
+        self._hilo_lock = threading.Lock()  # no espera a una recarga en curso
+        self._datos = None
+        self._cargado = 0.0
+        self._hilo_pid = None
+        self._revision = None
+        self._marca = None
+        self.origen = None          # "disco" | "hoja": de dónde salió el snapshot actual
+
+    def get(self):
+        datos = self._datos
+        if datos is not None and time.time() - self._cargado < self.ttl:
+            METRICAS.contar("cache_consultas_total", cache=self.nombre_hoja, resultado="hit")
+            return datos
+
+        METRICAS.contar("cache_consultas_total", cache=self.nombre_hoja,
+                        resultado="miss" if datos is None else "vencido")
+        if datos is None:
+            # Primera carga: todos esperan (la copia local si existe, si no Google)
+            with self._lock:
+                if self._datos is None and not self._cargar_de_disco():
+                    self._recargar()
+                return self._datos
+
+        # Vencido: recarga un solo hilo, el resto usa el snapshot anterior
+        if self._lock.acquire(blocking=False):
+            try:
+                if time.time() - self._cargado >= self.ttl:
+                    self._recargar()
+            except Exception as e:
+                log_evento("cache_error", hoja=self.nombre_hoja, error=str(e), se_usa="snapshot anterior")
+            finally:
+                self._lock.release()
+        return self._datos
+
+    def recargar(self, max_edad=None):
+        """Recarga ya. Con max_edad, solo si el snapshot es más viejo que eso."""
+        with self._lock:
+            if max_edad is None or self._datos is None or self.edad() > max_edad:
+                self._recargar()
+            return self._datos
+
+    def invalidar(self):
+        self._cargado = 0.0
+
+    def descartar(self):
+        """Olvida el snapshot (también la copia local): la próxima consulta espera una carga nueva."""
+        with self._lock:
+            self._datos = None
+            self._cargado = 0.0
+            self._revision = None
+            self.origen = None
+            with transaccion() as con:
+                con.execute("DELETE FROM snapshots_hoja WHERE hoja = ?", (self.nombre_hoja,))
+
+    def precargar(self):
+        """Al arrancar: carga la copia local si no hay snapshot. Devuelve el origen."""
+        if self._datos is None:
+            with self._lock:
+                if self._datos is None:
+                    self._cargar_de_disco()
+        return self.origen
+
+    def edad(self):
+        return time.time() - self._cargado
+
+    def refrescar_en_fondo(self, intervalo):
+        """Hilo (uno por proceso) que recarga cada `intervalo` segundos."""
+        pid = os.getpid()
+        if self._hilo_pid == pid:
+            return
+        with self._hilo_lock:
+            if self._hilo_pid == pid:
+                return
+            self._hilo_pid = pid
+        threading.Thread(
+            target=self._bucle_refresco, args=(intervalo,),
+            name=f"cache-{self.nombre_hoja}", daemon=True,
+        ).start()
+
+    def _bucle_refresco(self, intervalo):
+        while True:
+            try:
+                self.recargar(max_edad=intervalo * 0.9)
+            except Exception as e:
+                log_evento("cache_error", hoja=self.nombre_hoja, error=str(e), origen="refresco en segundo plano")
+            time.sleep(intervalo)
+
+    def _construir(self, registros, marca):
+        return self.construir(registros) if self.marca is None else self.construir(registros, marca)
+
+    def _recargar(self):
+        marca = None if self.marca is None else self.marca()
+        registros = get_ws(self.nombre_hoja).get_all_records()
+        texto = json.dumps(registros, ensure_ascii=False, separators=(",", ":"), default=str)
+        revision = hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+        if self._datos is None or revision != self._revision or marca != self._marca:
+            self._datos = self._construir(registros, marca)
+            self._revision, self._marca = revision, marca
+            try:
+                with transaccion() as con:
+                    con.execute(
+                        "INSERT OR REPLACE INTO snapshots_hoja (hoja, revision, marca, registros, guardado)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (self.nombre_hoja, revision, json.dumps(marca), texto, time.time()),
+                    )
+            except sqlite3.Error as e:
+                log_evento("snapshot_error", hoja=self.nombre_hoja, error=str(e))
+        self._cargado = time.time()
+        self.origen = "hoja"
+
+    def _cargar_de_disco(self):
+        """Carga la copia de SQLite (si hay) y lanza la actualización desde Google en segundo plano."""
+        try:
+            fila = get_db().execute(
+                "SELECT revision, marca, registros, guardado FROM snapshots_hoja WHERE hoja = ?",
+                (self.nombre_hoja,),
+            ).fetchone()
+            if fila is None:
+                return False
+            marca = json.loads(fila["marca"]) if fila["marca"] else None
+            self._datos = self._construir(json.loads(fila["registros"]), marca)
+        except (sqlite3.Error, ValueError, TypeError, KeyError) as e:
+            log_evento("snapshot_error", hoja=self.nombre_hoja, error=str(e))
+            return False
+
+        self._revision, self._marca = fila["revision"], marca
+        self._cargado = time.time()
+        self.origen = "disco"
+        log_evento("snapshot_local", hoja=self.nombre_hoja, revision=fila["revision"][:12],
+                   edad_seg=round(time.time() - fila["guardado"]))
+        threading.Thread(target=self._actualizar_copia, name=f"cache-{self.nombre_hoja}-inicial", daemon=True).start()
+        return True
+
+    def _actualizar_copia(self):
+        try:
+            self.recargar()
+        except Exception as e:
+            log_evento("snapshot_error", hoja=self.nombre_hoja, error=str(e), origen="actualización tras copia local")
 
-@app.route("/guardar_solicitud", methods=["POST"])
-def guardar_solicitud():
-    if "nombre" not in session:
-        return redirect(url_for("login"))
 
-    items_json = request.form.get("items_json", "").strip()
+# ===============================
+# CATALOGO (BUSQUEDA)
+# ===============================
+CATALOGO_TTL = int(os.environ.get("CATALOGO_TTL", "300"))
 
-    if not items_json:
-        flash("No hay ítems en la solicitud", "danger")
-        return redirect(url_for("solicitar"))
 
-    try:
-        items = json.loads(items_json)
-        ws = get_ws("Solicitudes")
+def _norm(valor):
+    return str(valor if valor is not None else "").strip().upper()
 
-        # ✅ FECHA Y HORA REAL DE PERÚ
-        fecha = datetime.now(ZoneInfo("America/Lima"))
-        fecha_str = fecha.strftime("%d/%m/%Y %H:%M")
 
-        solicitante = session.get("nombre")
+def _construir_catalogo(filas, stock_desde=0):
+    """
+    por_clave: (TIPO, DESCRIPCION) -> (codigo_sap, codigo_barras, um)
+    por_tipo:  TIPO -> items activos tal como los devuelve /api/catalogo
+    stock:     CODIGO -> STOCK de la hoja, que ya incluye las salidas del
+               libro de stock hasta el movimiento 'stock_desde'
+    """
+    por_clave = {}
+    por_tipo = defaultdict(list)
+    stock = {}
 
-        # ✅ generar ID_SOLICITUD único para toda la solicitud
-        id_solicitud = datetime.now(ZoneInfo("America/Lima")).strftime("%Y%m%d%H%M%S")
+    for fila in filas:
+        codigo = str(fila.get("CODIGO", "")).strip()
+        if codigo and codigo not in stock:
+            stock[codigo] = _numero_stock(fila.get("STOCK", ""))
 
-        # ✅ armamos 1 mensaje con lista
-        lista_items = []
-        for idx, item in enumerate(items, start=1):
-            descripcion = item.get("descripcion", "")
-            cantidad = item.get("cantidad", "")
-            lista_items.append(f"✅{idx}) {descripcion} (x{cantidad})")
+        tipo_fila = _norm(fila.get("TIPO", ""))
+        desc_fila = _norm(fila.get("DESCRIPCION", ""))
 
-        tipo_general = items[0].get("tipo", "")
-        descripcion_lista = "  |  ".join(lista_items)
+        clave = (tipo_fila, desc_fila)
+        if clave not in por_clave:  # como antes: gana la primera coincidencia
+            codigo_sap = str(fila.get("CODIGO", "")).strip()
 
-        # ✅ suma real de cantidades
-        cantidad_total = 0
-        for it in items:
-            try:
-                cantidad_total += int(str(it.get("cantidad", "0")).strip() or 0)
-            except:
-                cantidad_total += 0
+            um = str(fila.get("U.M", "")).strip() or str(fila.get("UM", "")).strip()
 
-        # ✅ GUARDAR EN GOOGLE SHEETS (1 fila por cada item)
-        for item in items:
-            tipo = item.get("tipo", "").strip()
-            descripcion = item.get("descripcion", "").strip()
-            cantidad = str(item.get("cantidad", "")).strip()
+            # CODIGO_BARRAS puede estar guardado o lo generamos automático
+            codigo_barras = str(fila.get("CODIGO_BARRAS", "")).strip()
 
-            # ✅ BUSCAR EN CATALOGO: CODIGO SAP + CODIGO BARRAS + UM
-            codigo_sap, codigo_barras, um = buscar_en_catalogo(tipo, descripcion)
+            if not codigo_barras and codigo_sap:
+                # Formato Code39 para lectura con Free 3 of 9
+                codigo_barras = f"*{codigo_sap}*"
 
-            ws.append_row([
-                id_solicitud,     # A ID_SOLICITUD
-                fecha_str,        # B FECHA
-                solicitante,      # C SOLICITANTE
-                tipo,             # D TIPO
-                codigo_sap,       # E CODIGO_SAP
-                descripcion,      # F DESCRIPCION
-                um,               # G UM
-                cantidad,         # H CANTIDAD
-                "PENDIENTE",      # I ESTADO
-                ""                # J ALMACENERO
-            ])
+            por_clave[clave] = (codigo_sap, codigo_barras, um)
+
+        if _norm(fila.get("ACTIVO", "")) == "SI":
+            por_tipo[tipo_fila].append({
+                "codigo_sap": fila.get("CODIGO", ""),
+                "tipo": fila.get("TIPO", ""),
+                "descripcion": fila.get("DESCRIPCION", ""),
+                "um": fila.get("U.M", ""),
+                "stock": fila.get("STOCK", ""),
+                "reservado": 0,
+                "disponible": fila.get("STOCK", ""),
+                "codigo_barras": fila.get("CODIGO_BARRAS", "")
+            })
 
-        # ✅ ENVIAR WHATSAPP (UN SOLO MENSAJE)
-        enviar_whatsapp_solicitud(solicitante, items)
+    busqueda = {tipo: _indexar_busqueda(items) for tipo, items in por_tipo.items()}
+    payloads = {tipo: _precomputar_payload(items) for tipo, items in por_tipo.items()}
+    payloads[""] = _precomputar_payload([])  # tipo desconocido / sin items
+
+    return {
+        "por_clave": por_clave,
+        "por_tipo": dict(por_tipo),
+        "busqueda": busqueda,
+        "payloads": payloads,
+        "stock": stock,
+        "stock_desde": stock_desde,
+    }
 
-        flash("✅ Solicitud registrada. El almacén la atenderá en breve.", "success")
-        return redirect(url_for("solicitar"))
 
-    except Exception as e:
-        print("ERROR guardar_solicitud:", e)
-        flash(f"Error al guardar solicitud: {e}", "danger")
-        return redirect(url_for("solicitar"))
+CATALOGO = CacheHoja("Catalogo", _construir_catalogo, CATALOGO_TTL, marca=lambda: stock_escrito_hasta())
 
 
 # ===============================
-# BANDEJA AGRUPADA (CORREGIDA)
+# CATALOGO (RESPUESTAS PRECALCULADAS)
 # ===============================
-@app.route("/bandeja")
-def bandeja():
-    if "rol" not in session or session.get("rol") != "ALMACEN":
-        return redirect(url_for("login"))
+# Cada vez que cambia el snapshot se arma, por TIPO, el JSON de /api/catalogo
+# ya comprimido (gzip y, si está instalado, brotli) con su ETag.
+CATALOGO_MAX_AGE = int(os.environ.get("CATALOGO_MAX_AGE", "60"))
 
-    ws = get_ws("Solicitudes")
-    filas = ws.get_all_values()
-
-    # A ID_SOLICITUD
-    # B FECHA
-    # C SOLICITANTE
-    # D TIPO
-    # E CODIGO_SAP
-    # F DESCRIPCION
-    # G UM
-    # H CANTIDAD
-    # I ESTADO
-    # J ALMACENERO
-    grupos = defaultdict(list)
 
-    # Recorremos filas (desde la 2 porque la 1 es cabecera)
-    for i, fila in enumerate(filas[1:], start=2):
-        id_solicitud = fila[0] if len(fila) > 0 else ""
-        fecha = fila[1] if len(fila) > 1 else ""
-        solicitante = fila[2] if len(fila) > 2 else ""
-        tipo = fila[3] if len(fila) > 3 else ""
-        codigo_sap = fila[4] if len(fila) > 4 else ""
-        descripcion = fila[5] if len(fila) > 5 else ""
-        um = fila[6] if len(fila) > 6 else ""
-        cantidad = fila[7] if len(fila) > 7 else ""
-        estado = fila[8] if len(fila) > 8 else ""
-        almacenero = fila[9] if len(fila) > 9 else ""
-
-        if id_solicitud.strip() == "":
-            continue
+def _precomputar_payload(items):
+    cuerpo = json.dumps({"items": items}, separators=(",", ":")).encode("utf-8")
+    digest = hashlib.sha256(cuerpo).hexdigest()[:20]
 
-        grupos[id_solicitud].append({
-            "fila": i,  # fila real en Google Sheets (para actualizar_estado)
-            "id_solicitud": id_solicitud,
-            "fecha": fecha,
-            "solicitante": solicitante,
-            "tipo": tipo,
-            "codigo_sap": codigo_sap,
-            "descripcion": descripcion,
-            "um": um,
-            "cantidad": cantidad,
-            "estado": estado,
-            "almacenero": almacenero,
-        })
+    variantes = {"identity": cuerpo, "gzip": gzip.compress(cuerpo, compresslevel=6)}
+    if brotli is not None:
+        variantes["br"] = brotli.compress(cuerpo, quality=9)
 
-    # Armamos lista final para la vista (agrupada)
-    solicitudes_agrupadas = []
-    for id_s, detalle in grupos.items():
-        cab = detalle[0]
-        solicitudes_agrupadas.append({
-            "id_solicitud": id_s,
-            "fecha": cab["fecha"],
-            "solicitante": cab["solicitante"],
-            "tipo": cab["tipo"],
-            "estado": cab["estado"],
-            "almacenero": cab["almacenero"],
-            "detalle": detalle,   # ✅ OJO: 'detalle' (NO 'items')
-        })
+    return {"hash": digest, "variantes": variantes}
 
-    # Ordenar por id desc (más reciente arriba)
-    solicitudes_agrupadas = sorted(
-        solicitudes_agrupadas,
-        key=lambda x: x["id_solicitud"],
-        reverse=True
-    )
 
-    return render_template("bandeja.html", solicitudes=solicitudes_agrupadas)
+def respuesta_precalculada(payload):
+    """Elige la codificación aceptada, responde 304 si el ETag coincide."""
+    aceptadas = request.accept_encodings
+    codificacion = "identity"
+    for cod in ("br", "gzip"):
+        if cod in payload["variantes"] and aceptadas[cod]:
+            codificacion = cod
+            break
+
+    etag = f"{payload['hash']}-{codificacion}"
+    cache_control = f"private, max-age={CATALOGO_MAX_AGE}, must-revalidate"
+
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(payload["variantes"][codificacion], mimetype="application/json")
+        if codificacion != "identity":
+            resp.headers["Content-Encoding"] = codificacion
+
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
 
 # ===============================
-# ACTUALIZAR ESTADO
+# CATALOGO (BUSQUEDA RANKEADA)
 # ===============================
-@app.route("/actualizar_estado", methods=["POST"])
-def actualizar_estado():
-    if "rol" not in session or session.get("rol") != "ALMACEN":
-        return redirect(url_for("login"))
+# Índice por TIPO sobre DESCRIPCION + CODIGO, sin tildes ni mayúsculas:
+# - prefijos de cada palabra (lo que se va tipeando)
+# - trigramas (tolera errores de tipeo)
+BUSQUEDA_PREFIJO_MAX = 12
+BUSQUEDA_SIMILITUD_MIN = 0.6
 
-    fila = int(request.form.get("fila"))
-    nuevo_estado = request.form.get("estado", "").strip().upper()
-    almacenero = session.get("nombre")
 
-    try:
-        ws = get_ws("Solicitudes")
+def _sin_acentos(texto):
+    texto = unicodedata.normalize("NFKD", str(texto if texto is not None else ""))
+    return "".join(c for c in texto if not unicodedata.combining(c)).lower()
 
-        # I=10 estado, J=11 almacenero
-        ws.update_cell(fila, 10, nuevo_estado)
-        ws.update_cell(fila, 11, almacenero)
 
-        flash(f"Solicitud {nuevo_estado}", "success")
+def _tokens(texto):
+    return re.findall(r"[a-z0-9]+", _sin_acentos(texto))
 
-    except Exception as e:
-        flash(f"Error al actualizar: {e}", "danger")
 
-    return redirect(url_for("bandeja"))
+def _trigramas(token):
+    t = f"  {token} "
+    return {t[i:i + 3] for i in range(len(t) - 2)}
 
 
-# ===============================
-# GENERAR VALE (COPIAR ITEMS A VALE_SALIDA)
-# ===============================
-@app.route("/generar_vale/<id_solicitud>", methods=["POST"])
-def generar_vale(id_solicitud):
-    if "rol" not in session or session.get("rol") != "ALMACEN":
-        return redirect(url_for("login"))
+def _indexar_busqueda(items):
+    prefijos = defaultdict(set)
+    trigramas = defaultdict(set)
+    tokens_items = []
 
-    try:
-        wsSol = get_ws("Solicitudes")
-        wsVale = get_ws("VALE_SALIDA")
+    for i, it in enumerate(items):
+        tokens = _tokens(f"{it['descripcion']} {it['codigo_sap']}")
+        tokens_items.append(tokens)
+        for tok in set(tokens):
+            for n in range(1, min(len(tok), BUSQUEDA_PREFIJO_MAX) + 1):
+                prefijos[tok[:n]].add(i)
+            for tri in _trigramas(tok):
+                trigramas[tri].add(i)
 
-        filas = wsSol.get_all_values()
+    return {
+        "items": items,
+        "tokens": tokens_items,
+        "prefijos": dict(prefijos),
+        "trigramas": dict(trigramas),
+    }
 
-        items = []
-        cabecera = None
-        filas_para_actualizar = []  # filas reales en sheet Solicitudes
 
-        # ===============================
-        # 1) Buscar todos los items del ID_SOLICITUD
-        # ===============================
-        for idx, fila in enumerate(filas[1:], start=2):  # idx = fila real en Sheets
-            if len(fila) < 10:
-                continue
+def buscar_catalogo(tipo, q, limite=20):
+    """Top-N items activos del TIPO que coinciden con q, mejor puntaje primero."""
+    indice = CATALOGO.get()["busqueda"].get(_norm(tipo))
+    q_tokens = _tokens(q)
+    if not indice or not q_tokens:
+        return []
 
-            if fila[0].strip() == id_solicitud.strip():
-                if cabecera is None:
-                    cabecera = {
-                        "id": fila[0],
-                        "fecha": fila[1],
-                        "solicitante": fila[2],
-                        "tipo": fila[3]
-                    }
-
-                items.append({
-                    "codigo_sap": fila[4],
-                    "descripcion": fila[5],
-                    "um": fila[6],
-                    "cantidad": fila[7],
-                })
-
-                filas_para_actualizar.append(idx)
-
-        if not items:
-            flash("❌ No se encontraron items para esta solicitud", "danger")
-            return redirect(url_for("bandeja"))
-
-        almacenero = session.get("nombre", "")
-
-        # ===============================
-        # 2) LIMPIAR SOLO ZONA DE ITEMS (NO TOCAR EL DISEÑO)
-        # ===============================
-        # Borra solo tabla de items (filas 6 a 15 aprox)
-        wsVale.batch_clear(["A6:K15", "B6:B15", "C6:C15", "D6:D15", "G6:G15", "H6:H15", "I6:I15", "K6:K15"])
-
-        # ===============================
-        # 3) CARGAR CABECERA DEL VALE (CELDAS EXACTAS)
-        # ===============================
-        # FECHA ACTUAL (momento de generar el vale)
-        fecha_vale = datetime.now(ZoneInfo("America/Lima")).strftime("%d/%m/%Y %H:%M")
-        wsVale.update("J2", [[fecha_vale]])
+    items = indice["items"]
+    tokens_items = indice["tokens"]
+
+    # 1) Todas las palabras de q como prefijo de alguna palabra del item
+    candidatos = None
+    for tok in q_tokens:
+        ids = indice["prefijos"].get(tok[:BUSQUEDA_PREFIJO_MAX], set())
+        if len(tok) > BUSQUEDA_PREFIJO_MAX:
+            ids = {i for i in ids if any(t.startswith(tok) for t in tokens_items[i])}
+        candidatos = ids if candidatos is None else candidatos & ids
+
+    puntajes = {}
+    for i in candidatos:
+        tokens = tokens_items[i]
+        puntaje = 2.0
+        if tokens and tokens[0].startswith(q_tokens[0]):
+            puntaje += 0.5
+        puntaje += 0.1 * sum(1 for tok in q_tokens if tok in tokens)
+        puntajes[i] = puntaje
+
+    # 2) Similitud por trigramas para lo que no coincidió por prefijo
+    #    (los códigos numéricos solo coinciden por prefijo)
+    q_trigramas = set()
+    for tok in q_tokens:
+        if not tok.isdigit():
+            q_trigramas |= _trigramas(tok)
+
+    coincidencias = defaultdict(int)
+    for tri in q_trigramas:
+        for i in indice["trigramas"].get(tri, ()):
+            coincidencias[i] += 1
+
+    for i, n in coincidencias.items():
+        similitud = n / len(q_trigramas)  # q_trigramas no vacío si hubo coincidencias
+        if i not in puntajes and similitud >= BUSQUEDA_SIMILITUD_MIN:
+            puntajes[i] = similitud
+
+    ranking = sorted(
+        puntajes,
+        key=lambda i: (-puntajes[i], len(str(items[i]["descripcion"])), str(items[i]["descripcion"]))
+    )
+    return [items[i] for i in ranking[:limite]]
 
-        # TRABAJADOR (solicitante)
-        wsVale.update("C4", [[cabecera["solicitante"]]])
 
-        # ALMACENERO (logueado)
-        wsVale.update("F4", [[almacenero]])
+def buscar_en_catalogo(tipo, descripcion):
+    """
+    Busca en hoja Catalogo (cache en memoria) según tipo + descripcion
+    Devuelve: codigo_sap, codigo_barras, um
+    """
+    clave = (_norm(tipo), _norm(descripcion))
+    return CATALOGO.get()["por_clave"].get(clave, ("", "", ""))
 
-        # ===============================
-        # 🔹 DATOS DEL TRABAJADOR DESDE USUARIOS
-        # ===============================
-        codigo_trab = ""
-        cargo_trab = ""
-        area_trab = ""
 
-        wsUsuarios = get_ws("Usuarios")
-        filas_usr = wsUsuarios.get_all_records()
+# ===============================
+# USUARIOS (DIRECTORIO EN MEMORIA)
+# ===============================
+# Índices por CODIGO y por nombre normalizado (mayúsculas, sin tildes),
+# refrescados en segundo plano. Lo usan el login y los datos del vale.
+USUARIOS_REFRESCO_SEG = int(os.environ.get("USUARIOS_REFRESCO_SEG", "300"))
+USUARIOS_RECARGA_MISS_SEG = 60  # código desconocido: recargar como mucho 1 vez por minuto
 
-        nombre_sol = str(cabecera["solicitante"]).strip().upper()
 
-        for fila in filas_usr:
-            nombre_usr = str(fila.get("NOMBRE", "")).strip().upper()
-            nombre_usr2 = str(fila.get("NOMBRE COMPLETO", "")).strip().upper()
+def _norm_nombre(valor):
+    return " ".join(_sin_acentos(valor).upper().split())
 
-            if nombre_sol == nombre_usr or nombre_sol == nombre_usr2:
-                codigo_trab = str(fila.get("CODIGO", "")).strip()
-                cargo_trab = str(fila.get("CARGO", "")).strip()
-                area_trab = str(fila.get("AREA", "")).strip()
-                break
 
-        # ===============================
-        # 4) CARGAR ITEMS (fila 6 en adelante)
-        # ===============================
-        fila_inicio = 6
+def _construir_usuarios(filas):
+    por_codigo = {}
+    por_nombre = {}
 
-        datos = []
+    for fila in filas:
+        usuario = {
+            "codigo": str(fila.get("CODIGO", "")).strip(),
+            "nombre": str(fila.get("NOMBRE COMPLETO", "")).strip(),
+            "cargo": str(fila.get("CARGO", "")).strip(),
+            "area": str(fila.get("AREA", "")).strip(),
+            "rol": str(fila.get("ROL", "")).strip(),
+        }
 
-        n = 1
+        # como antes: gana la primera fila que coincide
+        if usuario["codigo"]:
+            por_codigo.setdefault(usuario["codigo"], usuario)
 
-        for it in items:
-            fila = [""] * 11  # columnas A-G
-
-            fila[0] = n                        # A
-            fila[1] = it["codigo_sap"]        # B
-            fila[2] = it["descripcion"]       # C
-            fila[5] = it["cantidad"]          # F
-            fila[6] = it["um"]                # G
-            fila[7] = "NUEVO"                 # H
-            fila[9] = "CAMBIO"                # J
-
-            datos.append(fila)
-
-            n += 1
-
-        # Escribir todo en una sola operación
-        rango = f"A{fila_inicio}:K{fila_inicio + len(datos) - 1}"
-
-        wsVale.update(rango, datos)
-
-        # ===============================
-        # 5) MARCAR SOLICITUD COMO ATENDIDA (TODAS LAS FILAS DEL ID)
-        # ===============================
-        # I=10 ESTADO, J=11 ALMACENERO
-        updates = []
-        for fila_real in filas_para_actualizar:
-            updates.append({
-                "range": f"I{fila_real}:J{fila_real}",
-                "values": [["ATENDIDO", almacenero]]
-            })
+        for campo in ("NOMBRE", "NOMBRE COMPLETO"):
+            clave = _norm_nombre(fila.get(campo, ""))
+            if clave:
+                por_nombre.setdefault(clave, usuario)
 
-        wsSol.batch_update(updates)
+    return {"por_codigo": por_codigo, "por_nombre": por_nombre}
 
-        flash("✅ VALE generado y solicitud marcada como ATENDIDO", "success")
+
+# El TTL es la red de seguridad si el hilo de refresco se detuviera
+USUARIOS = CacheHoja("Usuarios", _construir_usuarios, USUARIOS_REFRESCO_SEG * 3)
+
+
+def buscar_usuario_por_nombre(nombre):
+    usuario = USUARIOS.get()["por_nombre"].get(_norm_nombre(nombre))
+    return dict(usuario) if usuario else None
+
+
+# ===============================
+# REPLICA LOCAL DE SOLICITUDES
+# ===============================
+# Copia de la hoja Solicitudes en SQLite. Solo se traen de Google las filas
+# nuevas (desde la última fila conocida); las escrituras de la app se
+# registran aquí directamente. Cada REPLICA_FULL_SEG se reconstruye completa
+# para recoger ediciones hechas a mano en la hoja.
+REPLICA_SYNC_SEG = float(os.environ.get("REPLICA_SYNC_SEG", "15"))
+REPLICA_FULL_SEG = float(os.environ.get("REPLICA_FULL_SEG", "600"))
+
+COLUMNAS_SOLICITUDES = [
+    "id_solicitud",  # A
+    "fecha",         # B
+    "solicitante",   # C
+    "tipo",          # D
+    "codigo_sap",    # E
+    "descripcion",   # F
+    "um",            # G
+    "cantidad",      # H
+    "estado",        # I
+    "almacenero",    # J
+    "vale",          # K (lo escribe el vale)
+    "fecha_vale",    # L
+]
+
+
+def _fecha_iso(fecha):
+    try:
+        return datetime.strptime(fecha.strip(), "%d/%m/%Y %H:%M").strftime("%Y-%m-%d %H:%M")
+    except Exception:
+        return ""
+
+
+def _fila_replica(n, valores):
+    valores = [str(v) for v in valores[:12]] + [""] * (12 - len(valores))
+    vale = valores[10].strip()
+    return (
+        n, valores[0].strip(), valores[1], _fecha_iso(valores[1]), valores[2], valores[3],
+        valores[4], valores[5], valores[6], valores[7], valores[8], valores[9],
+        int(vale) if vale.isdigit() else None, valores[11],
+    )
+
+
+def _guardar_filas_replica(con, inicio, filas):
+    registros = [_fila_replica(n, f) for n, f in enumerate(filas, start=inicio)]
+    con.executemany(
+        "INSERT OR REPLACE INTO solicitudes (fila, id_solicitud, fecha, fecha_iso, solicitante, tipo,"
+        " codigo_sap, descripcion, um, cantidad, estado, almacenero, vale, fecha_vale)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [r for r in registros if r[1]],
+    )
+    con.executemany("DELETE FROM solicitudes WHERE fila = ?", [(r[0],) for r in registros if not r[1]])
+
+
+def _meta(con, clave, defecto=0.0):
+    f = con.execute("SELECT valor FROM replica_meta WHERE clave = ?", (clave,)).fetchone()
+    return f["valor"] if f else defecto
+
+
+def _set_meta(con, clave, valor):
+    con.execute("INSERT OR REPLACE INTO replica_meta (clave, valor) VALUES (?, ?)", (clave, valor))
+
+
+def reconstruir_replica():
+    """Descarga la hoja completa y reemplaza la réplica."""
+    filas = get_ws("Solicitudes").get_all_values()
+    ahora = time.time()
+    with transaccion() as con:
+        con.execute("DELETE FROM solicitudes")
+        _guardar_filas_replica(con, 2, filas[1:])
+        _set_meta(con, "filas", len(filas))
+        _set_meta(con, "ultima_sync", ahora)
+        _set_meta(con, "ultima_full", ahora)
+
+
+def sincronizar_solicitudes(forzar=False):
+    """
+    Trae a la réplica las filas agregadas desde la última sincronización.
+    Entre workers solo uno sincroniza por ventana de REPLICA_SYNC_SEG.
+    """
+    ahora = time.time()
+    with transaccion() as con:
+        filas_conocidas = int(_meta(con, "filas"))
+        ultima_sync = _meta(con, "ultima_sync")
+        ultima_full = _meta(con, "ultima_full")
+
+        if not forzar and filas_conocidas and ahora - ultima_sync < REPLICA_SYNC_SEG:
+            METRICAS.contar("replica_sync_total", tipo="omitida")
+            return
+        _set_meta(con, "ultima_sync", ahora)
+
+    if not filas_conocidas or ahora - ultima_full >= REPLICA_FULL_SEG:
+        METRICAS.contar("replica_sync_total", tipo="completa")
+        reconstruir_replica()
+        return
+
+    METRICAS.contar("replica_sync_total", tipo="incremental")
+
+    try:
+        nuevas = get_ws("Solicitudes").get(f"A{filas_conocidas + 1}:L")
+    except _api_error() as e:
+        if "exceeds grid limits" in str(e):
+            return  # la hoja no tiene filas después de la última conocida
+        raise
+
+    if not nuevas:
+        return
+
+    with transaccion() as con:
+        _guardar_filas_replica(con, filas_conocidas + 1, nuevas)
+        _set_meta(con, "filas", max(int(_meta(con, "filas")), filas_conocidas + len(nuevas)))
+
+
+def replica_registrar_append(respuesta, filas, generacion=None):
+    """
+    Registra en la réplica las filas que acabamos de agregar con append_rows.
+    'generacion' es generacion_filas() leída antes del append: si entretanto
+    se archivaron filas, el número de fila devuelto ya no sirve.
+    """
+    try:
+        rango = respuesta["updates"]["updatedRange"]        # 'Solicitudes'!A15:J17
+        inicio = int(re.search(r"![A-Z]+(\d+)", rango).group(1))
+    except Exception:
+        # No sabemos en qué fila quedaron: que la próxima lectura sincronice
+        with transaccion() as con:
+            _set_meta(con, "ultima_sync", 0.0)
+        return
+
+    try:
+        with transaccion() as con:
+            if generacion is not None and _meta(con, "generacion") != generacion:
+                _set_meta(con, "ultima_sync", 0.0)
+                _set_meta(con, "ultima_full", 0.0)
+                return
+            _guardar_filas_replica(con, inicio, filas)
+    except sqlite3.Error as e:
+        # Las filas ya están en Sheets: la sincronización incremental las trae
+        # igual ('filas' no avanzó); solo se adelanta a la próxima lectura
+        log_evento("replica_error", error=str(e), origen="append")
+        try:
+            get_db().execute("UPDATE replica_meta SET valor = 0 WHERE clave = 'ultima_sync'")
+        except sqlite3.Error:
+            pass
+
+
+def replica_cambiar_estados(con, cambios):
+    """cambios: [(fila, estado, almacenero), ...]; también ajusta los resúmenes."""
+    previas = {}
+    for i in range(0, len(cambios), 500):
+        lote = [c[0] for c in cambios[i:i + 500]]
+        for f in con.execute(f"SELECT * FROM solicitudes WHERE fila IN ({', '.join('?' * len(lote))})", lote):
+            previas[f["fila"]] = f
+
+    con.executemany(
+        "UPDATE solicitudes SET estado = ?, almacenero = ? WHERE fila = ?",
+        [(estado, almacenero, fila) for fila, estado, almacenero in cambios],
+    )
+    resumen_ajustar_entregas(con, [(previas[fila], estado) for fila, estado, _ in cambios if fila in previas])
+
+
+def replica_actualizar_estado(filas, estado, almacenero):
+    with transaccion() as con:
+        replica_cambiar_estados(con, [(f, estado, almacenero) for f in filas])
+
+
+def leer_solicitudes(where="1 = 1", params=()):
+    """Filas de la réplica (dicts con 'fila' + COLUMNAS_SOLICITUDES), en orden de hoja."""
+    cursor = get_db().execute(
+        f"SELECT fila, {', '.join(COLUMNAS_SOLICITUDES)} FROM solicitudes WHERE {where} ORDER BY fila",
+        params,
+    )
+    return [dict(f) for f in cursor]
+
+
+# ===============================
+# EVENTOS DE BANDEJA (SSE)
+# ===============================
+# Las rutas que escriben publican el evento en SQLite (lo ven todos los
+# workers) y un hilo por proceso lo reparte a las conexiones /bandeja/stream
+# abiertas en ese proceso. El navegador solo pide la tarjeta que cambió.
+EVENTOS_POLL_SEG = float(os.environ.get("EVENTOS_POLL_SEG", "1"))
+EVENTOS_HEARTBEAT_SEG = float(os.environ.get("EVENTOS_HEARTBEAT_SEG", "15"))
+EVENTOS_CONEXION_MAX_SEG = float(os.environ.get("EVENTOS_CONEXION_MAX_SEG", "300"))
+EVENTOS_REPLAY_MAX = 500
+EVENTOS_RETENCION_SEG = 86400
+
+_eventos_lock = threading.Lock()
+_eventos_estado = {"pid": None, "despertar": None, "suscriptores": set()}
+
+
+def publicar_evento(tipo, ids_solicitud=()):
+    """Registra un evento por solicitud (o uno sin id, p.ej. 'recarga')."""
+    ahora = time.time()
+    filas = [(tipo, i, ahora) for i in dict.fromkeys(ids_solicitud)] or [(tipo, None, ahora)]
+    try:
+        with transaccion() as con:
+            con.executemany("INSERT INTO eventos_bandeja (tipo, id_solicitud, creado) VALUES (?, ?, ?)", filas)
+    except sqlite3.Error as e:
+        # La escritura en Sheets ya se hizo: sin evento la bandeja se ve al recargar
+        log_evento("evento_bandeja_error", tipo=tipo, error=str(e))
+        return
+
+    if _eventos_estado["pid"] == os.getpid():
+        _eventos_estado["despertar"].set()
+
+
+def ultimo_evento_id():
+    return get_db().execute("SELECT COALESCE(MAX(id), 0) FROM eventos_bandeja").fetchone()[0]
+
+
+def iniciar_eventos():
+    """Arranca (una vez por proceso) el hilo que reparte eventos a los suscriptores."""
+    pid = os.getpid()
+    if _eventos_estado["pid"] == pid:
+        return
+
+    with _eventos_lock:
+        if _eventos_estado["pid"] == pid:
+            return
+        _eventos_estado["despertar"] = threading.Event()
+        _eventos_estado["suscriptores"] = set()
+        threading.Thread(target=_repartir_eventos, args=(ultimo_evento_id(),),
+                         name="eventos-bandeja", daemon=True).start()
+        _eventos_estado["pid"] = pid
+
+
+def _repartir_eventos(ultimo):
+    despertar = _eventos_estado["despertar"]
+    ultima_purga = 0.0
+    while True:
+        try:
+            con = get_db()
+            if time.time() - ultima_purga > 3600:
+                con.execute("DELETE FROM eventos_bandeja WHERE creado < ?", (time.time() - EVENTOS_RETENCION_SEG,))
+                ultima_purga = time.time()
+
+            eventos = [
+                dict(f) for f in con.execute(
+                    "SELECT id, tipo, id_solicitud FROM eventos_bandeja WHERE id > ? ORDER BY id",
+                    (ultimo,),
+                )
+            ]
+            if eventos:
+                ultimo = eventos[-1]["id"]
+                with _eventos_lock:
+                    suscriptores = list(_eventos_estado["suscriptores"])
+                for cola in suscriptores:
+                    for ev in eventos:
+                        cola.put(ev)
+        except Exception as e:
+            log_evento("eventos_bandeja_error", error=str(e))
+
+        despertar.wait(EVENTOS_POLL_SEG)
+        despertar.clear()
+
+
+def _formatear_sse(ev):
+    datos = json.dumps({"tipo": ev["tipo"], "id_solicitud": ev["id_solicitud"]})
+    return f"id: {ev['id']}\ndata: {datos}\n\n"
+
+
+def flujo_eventos(desde):
+    """Generador SSE: reenvía lo ocurrido después de 'desde' (None = solo lo nuevo)."""
+    iniciar_eventos()
+    cola = queue.Queue()
+    with _eventos_lock:
+        _eventos_estado["suscriptores"].add(cola)
+    METRICAS.contar("bandeja_stream_conexiones_total")
+
+    # Suscritos antes de leer el historial: nada se pierde entre ambos pasos
+    if desde is None:
+        desde = ultimo_evento_id()
+    pendientes = [
+        dict(f) for f in get_db().execute(
+            "SELECT id, tipo, id_solicitud FROM eventos_bandeja WHERE id > ? ORDER BY id LIMIT ?",
+            (desde, EVENTOS_REPLAY_MAX + 1),
+        )
+    ]
+
+    def generar():
+        ultimo = desde
+        try:
+            yield "retry: 3000\n\n"
+
+            if len(pendientes) > EVENTOS_REPLAY_MAX:
+                # Demasiado atrasado: que recargue la página entera
+                yield _formatear_sse({"id": pendientes[-1]["id"], "tipo": "recarga", "id_solicitud": None})
+                return
+
+            for ev in pendientes:
+                ultimo = ev["id"]
+                yield _formatear_sse(ev)
+
+            # Vida máxima: el navegador reconecta solo (con Last-Event-ID)
+            fin = time.time() + EVENTOS_CONEXION_MAX_SEG
+            while time.time() < fin:
+                try:
+                    ev = cola.get(timeout=EVENTOS_HEARTBEAT_SEG)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if ev["id"] <= ultimo:
+                    continue
+                ultimo = ev["id"]
+                yield _formatear_sse(ev)
+        finally:
+            with _eventos_lock:
+                _eventos_estado["suscriptores"].discard(cola)
+
+    return generar()
+
+
+# ===============================
+# ARCHIVO DE SOLICITUDES (HOJAS MENSUALES)
+# ===============================
+# Las solicitudes cerradas (todas sus filas ATENDIDO/RECHAZADO) con más de
+# ARCHIVO_DIAS se copian a hojas Solicitudes_YYYY_MM (mes de la FECHA) y se
+# borran de Solicitudes, así la hoja viva solo guarda lo pendiente y lo
+# reciente. Primero se copia y luego se borra: si algo falla entre ambos
+# pasos, la siguiente corrida no vuelve a copiar lo que ya figura en
+# solicitudes_archivo (copia local de todo lo archivado).
+# Borrar filas mueve los números de fila: mientras dura el archivo se
+# rechazan las escrituras por número de fila y al terminar se reconstruye
+# la réplica.
+ARCHIVO_DIAS = int(os.environ.get("ARCHIVO_DIAS", "90"))
+ARCHIVO_ESTADOS = ("ATENDIDO", "RECHAZADO")
+ARCHIVO_CADA_HORAS = float(os.environ.get("ARCHIVO_CADA_HORAS", "0"))  # 0 = solo con "flask archivar"
+ARCHIVO_GRACIA_SEG = float(os.environ.get("ARCHIVO_GRACIA_SEG", "5"))
+ARCHIVO_LEASE_SEG = 900
+
+_archivo_lock = threading.Lock()
+_archivo_estado = {"pid": None}
+
+
+class ArchivoEnCurso(RuntimeError):
+    pass
+
+
+class FilasDesactualizadas(RuntimeError):
+    pass
+
+
+def exigir_filas_estables():
+    """Llamar justo antes de escribir en Solicitudes por número de fila."""
+    if _meta(get_db(), "archivo_hasta") > time.time():
+        raise ArchivoEnCurso("se están archivando solicitudes antiguas, intente de nuevo en unos segundos")
+
+
+def ids_en_hoja(ws, filas):
+    """ID_SOLICITUD (columna A) que tiene hoy cada fila de `filas` (1 lectura)."""
+    actuales = ws.batch_get([f"A{f}" for f in filas])
+    return [str(v[0][0]).strip() if v and v[0] else "" for v in actuales]
+
+
+def invalidar_replica():
+    """La réplica no refleja la hoja: la próxima lectura la reconstruye."""
+    with transaccion() as con:
+        _set_meta(con, "ultima_sync", 0.0)
+        _set_meta(con, "ultima_full", 0.0)
+
+
+def generacion_filas():
+    """Cambia cada vez que se borran filas de Solicitudes."""
+    return _meta(get_db(), "generacion")
+
+
+def _hoja_archivo(fecha_iso):
+    return f"Solicitudes_{fecha_iso[:4]}_{fecha_iso[5:7]}"
+
+
+def _filas_para_archivar(con, limite_iso):
+    """Filas de las solicitudes cerradas cuya FECHA es anterior a limite_iso."""
+    marcas = ", ".join("?" * len(ARCHIVO_ESTADOS))
+    cursor = con.execute(
+        f"SELECT fila, {', '.join(COLUMNAS_SOLICITUDES)}, fecha_iso FROM solicitudes WHERE id_solicitud IN ("
+        "  SELECT id_solicitud FROM solicitudes GROUP BY id_solicitud"
+        f"  HAVING SUM(UPPER(TRIM(estado)) NOT IN ({marcas})) = 0"
+        "     AND MIN(fecha_iso) != '' AND MAX(fecha_iso) < ?"
+        ") ORDER BY fila",
+        (*ARCHIVO_ESTADOS, limite_iso),
+    )
+    return [dict(f) for f in cursor]
+
+
+def _rangos_contiguos(filas):
+    """[3, 4, 5, 9] -> [[3, 5], [9, 9]]"""
+    rangos = []
+    for f in sorted(filas):
+        if rangos and rangos[-1][1] == f - 1:
+            rangos[-1][1] = f
+        else:
+            rangos.append([f, f])
+    return rangos
+
+
+def archivar_solicitudes(dias=None, simular=False):
+    """
+    Mueve a las hojas de archivo las solicitudes cerradas con más de 'dias'.
+    Devuelve un resumen, o None si otro proceso ya está archivando.
+    Llamadas a Sheets: 2 lecturas completas (antes/después), crear hojas
+    nuevas (si hace falta), 1 append por hoja de archivo, 1 lectura de la
+    columna A para verificar y 1 batch_update con todos los borrados.
+    """
+    dias = ARCHIVO_DIAS if dias is None else dias
+    limite = (datetime.now(ZoneInfo("America/Lima")) - timedelta(days=dias)).strftime("%Y-%m-%d")
+
+    ahora = time.time()
+    with transaccion() as con:
+        if _meta(con, "archivo_hasta") > ahora:
+            return None
+        if not simular:
+            _set_meta(con, "archivo_hasta", ahora + ARCHIVO_LEASE_SEG)
+
+    try:
+        if not simular:
+            time.sleep(ARCHIVO_GRACIA_SEG)  # que terminen las escrituras que ya estaban en curso
+
+        reconstruir_replica()
+        con = get_db()
+        filas = _filas_para_archivar(con, limite)
+
+        por_hoja = defaultdict(list)
+        for f in filas:
+            por_hoja[_hoja_archivo(f["fecha_iso"])].append(f)
+
+        resumen = {
+            "limite": limite,
+            "solicitudes": len({f["id_solicitud"] for f in filas}),
+            "filas": len(filas),
+            "hojas": {h: len(v) for h, v in sorted(por_hoja.items())},
+        }
+        if simular or not filas:
+            return resumen
+
+        # Lo que ya se copió en una corrida anterior interrumpida solo se borra
+        ya_copiadas = {
+            f["id_solicitud"] for f in con.execute(
+                "SELECT DISTINCT id_solicitud FROM solicitudes_archivo WHERE fecha_iso < ?", (limite,)
+            )
+        }
+
+        sh = get_gsheet()
+        existentes = {ws.title for ws in sh.worksheets()}
+        nuevas = [h for h in por_hoja if h not in existentes]
+        if nuevas:
+            sh.batch_update({"requests": [{"addSheet": {"properties": {"title": h}}} for h in nuevas]})
+
+        cabecera = [c.upper() for c in COLUMNAS_SOLICITUDES]
+        for hoja, filas_hoja in sorted(por_hoja.items()):
+            copiar = [f for f in filas_hoja if f["id_solicitud"] not in ya_copiadas]
+            if not copiar:
+                continue
+
+            valores = [["" if f[c] is None else f[c] for c in COLUMNAS_SOLICITUDES] for f in copiar]
+            if hoja in nuevas:
+                valores.insert(0, cabecera)
+            sh.values_append(
+                "'" + hoja.replace("'", "''") + "'!A1",
+                params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+                body={"values": valores},
+            )
+
+            with transaccion() as con:
+                con.executemany(
+                    "INSERT INTO solicitudes_archivo (hoja, id_solicitud, fecha, fecha_iso, solicitante, tipo,"
+                    " codigo_sap, descripcion, um, cantidad, estado, almacenero, vale, fecha_vale, archivado)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(hoja, *[f[c] for c in COLUMNAS_SOLICITUDES[:2]], f["fecha_iso"],
+                      *[f[c] for c in COLUMNAS_SOLICITUDES[2:]], time.time()) for f in copiar],
+                )
+
+        # Antes de borrar: las filas deben seguir teniendo el id esperado
+        ws = get_ws("Solicitudes")
+        ids_hoja = ws.col_values(1)
+        movidas = [
+            f["fila"] for f in filas
+            if (str(ids_hoja[f["fila"] - 1]).strip() if f["fila"] <= len(ids_hoja) else "") != f["id_solicitud"]
+        ]
+        if movidas:
+            raise RuntimeError(f"Solicitudes cambió durante el archivo ({len(movidas)} filas); no se borró nada")
+
+        # De abajo hacia arriba para que cada borrado no mueva los siguientes
+        sh.batch_update({"requests": [
+            {"deleteDimension": {"range": {
+                "sheetId": ws.id, "dimension": "ROWS", "startIndex": inicio - 1, "endIndex": fin,
+            }}}
+            for inicio, fin in reversed(_rangos_contiguos(f["fila"] for f in filas))
+        ]})
+
+        with transaccion() as con:
+            _set_meta(con, "generacion", _meta(con, "generacion") + 1)
+        reconstruir_replica()
+
+    finally:
+        if not simular:
+            with transaccion() as con:
+                _set_meta(con, "archivo_hasta", 0.0)
+
+    METRICAS.contar("solicitudes_archivadas_total", len(filas))
+    log_evento("solicitudes_archivadas", **resumen)
+    publicar_evento("recarga")
+    return resumen
+
+
+def iniciar_archivo_automatico():
+    """Si ARCHIVO_CADA_HORAS > 0, un hilo por proceso; entre workers corre uno solo."""
+    pid = os.getpid()
+    if ARCHIVO_CADA_HORAS <= 0 or _archivo_estado["pid"] == pid:
+        return
+
+    with _archivo_lock:
+        if _archivo_estado["pid"] == pid:
+            return
+        threading.Thread(target=_archivar_periodicamente, name="archivo-solicitudes", daemon=True).start()
+        _archivo_estado["pid"] = pid
+
+
+def _archivar_periodicamente():
+    while True:
+        time.sleep(600 + random.uniform(0, 60))
+        try:
+            ahora = time.time()
+            with transaccion() as con:
+                toca = ahora - _meta(con, "ultimo_archivo") >= ARCHIVO_CADA_HORAS * 3600
+                if toca:
+                    _set_meta(con, "ultimo_archivo", ahora)
+            if toca:
+                archivar_solicitudes()
+        except Exception as e:
+            log_evento("archivo_error", error=str(e), tipo_error=type(e).__name__)
+
+
+@app.cli.command("archivar")
+@click.option("--dias", type=int, default=None, help=f"Antigüedad mínima (por defecto ARCHIVO_DIAS={ARCHIVO_DIAS}).")
+@click.option("--simular", is_flag=True, help="Solo muestra qué se archivaría.")
+def cli_archivar(dias, simular):
+    """Mueve las solicitudes cerradas antiguas a las hojas Solicitudes_YYYY_MM."""
+    resumen = archivar_solicitudes(dias, simular=simular)
+    if resumen is None:
+        click.echo("Otro proceso está archivando; intente más tarde.")
+        return
+
+    click.echo(f"{'(simulación) ' if simular else ''}{resumen['solicitudes']} solicitudes,"
+               f" {resumen['filas']} filas anteriores a {resumen['limite']}")
+    for hoja, n in resumen["hojas"].items():
+        click.echo(f"  {hoja}: {n} filas")
+
+
+# ===============================
+# WHATSAPP (OUTBOX EN SEGUNDO PLANO)
+# ===============================
+# La ruta solo encola; un hilo despachador reparte los envíos a un pool de
+# hilos que usan una sesión HTTP compartida. Reintentos con backoff y, al
+# agotarlos (o ante un 4xx definitivo), el mensaje queda MUERTO para revisión.
+WHATSAPP_API_URL = os.environ.get("WHATSAPP_API_URL", "https://graph.facebook.com/v18.0").rstrip("/")
+WHATSAPP_TIMEOUT = float(os.environ.get("WHATSAPP_TIMEOUT", "20"))
+WHATSAPP_HILOS = int(os.environ.get("WHATSAPP_HILOS", "4"))
+WHATSAPP_MAX_INTENTOS = int(os.environ.get("WHATSAPP_MAX_INTENTOS", "6"))
+WHATSAPP_BACKOFF_BASE = float(os.environ.get("WHATSAPP_BACKOFF_BASE", "5"))
+WHATSAPP_BACKOFF_MAX = float(os.environ.get("WHATSAPP_BACKOFF_MAX", "600"))
+OUTBOX_POLL_SEG = float(os.environ.get("OUTBOX_POLL_SEG", "2"))
+OUTBOX_LEASE_SEG = WHATSAPP_TIMEOUT * 3  # si un worker muere con el envío tomado
+OUTBOX_RETENCION_DIAS = int(os.environ.get("OUTBOX_RETENCION_DIAS", "7"))
+
+# Modo resumen (opcional): en ráfagas (inicio de turno) las solicitudes que
+# llegan dentro de WHATSAPP_RESUMEN_SEG desde el último envío se juntan en
+# un solo mensaje por destinatario, que sale al cerrar la ventana o al
+# llegar a WHATSAPP_RESUMEN_MAX_ITEMS ítems. Si no hubo envíos en la última
+# ventana, la solicitud sale de inmediato como siempre. 0 = desactivado.
+WHATSAPP_RESUMEN_SEG = float(os.environ.get("WHATSAPP_RESUMEN_SEG", "0"))
+WHATSAPP_RESUMEN_MAX_ITEMS = int(os.environ.get("WHATSAPP_RESUMEN_MAX_ITEMS", "30"))
+WHATSAPP_MAX_CARACTERES = 3500  # la API corta el texto en 4096
+
+_outbox_lock = threading.Lock()
+_outbox_estado = {"pid": None, "despertar": None, "session": None}
+
+
+def enviar_whatsapp_solicitud(solicitante: str, items: list, id_solicitud: str = ""):
+    """Notificación WhatsApp: solicitante + ítems.
+    Destinatarios salen de Render (WHATSAPP_TOS).
+    Solo encola en el outbox: no bloquea la petición.
+    """
+    if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_ID:
+        log_evento("whatsapp_no_configurado")
+        return
+
+    tos = get_whatsapp_tos()
+    if not tos:
+        log_evento("whatsapp_sin_destinatarios")
+        return
+
+    try:
+        if WHATSAPP_RESUMEN_SEG > 0 and not _resumen_inmediato(solicitante, items, id_solicitud):
+            METRICAS.contar("whatsapp_solicitudes_total", modo="resumen")
+            return
+        METRICAS.contar("whatsapp_solicitudes_total", modo="inmediato")
+        encolar_whatsapp(tos, formatear_mensaje_whatsapp_solicitud(solicitante, items), id_solicitud)
+    except Exception as e:
+        log_evento("whatsapp_error_encolar", error=str(e), id_solicitud=id_solicitud)
+
+
+def _resumen_inmediato(solicitante, items, id_solicitud):
+    """
+    Modo resumen: True si la solicitud debe salir ya (nada enviado en la
+    última ventana). Si no, queda en whatsapp_resumen para el próximo resumen.
+    """
+    ahora = time.time()
+    with transaccion() as con:
+        esperando = con.execute(
+            "SELECT COALESCE(SUM(n_items), 0), COUNT(*) FROM whatsapp_resumen WHERE enviado IS NULL"
+        ).fetchone()
+        if not esperando[1] and ahora - _meta(con, "whatsapp_ultimo_envio") >= WHATSAPP_RESUMEN_SEG:
+            _set_meta(con, "whatsapp_ultimo_envio", ahora)
+            return True
+
+        con.execute(
+            "INSERT INTO whatsapp_resumen (id_solicitud, solicitante, hora, items, n_items, creado)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (id_solicitud, solicitante,
+             datetime.now(ZoneInfo("America/Lima")).strftime("%d/%m/%Y %H:%M"),
+             json.dumps([{k: it.get(k, "") for k in ("tipo", "descripcion", "cantidad")} for it in items],
+                        ensure_ascii=False),
+             len(items), ahora),
+        )
+        lleno = esperando[0] + len(items) >= WHATSAPP_RESUMEN_MAX_ITEMS
+
+    if lleno:
+        enviar_resumen_whatsapp()
+    return False
+
+
+def formatear_resumen_whatsapp(solicitudes):
+    """
+    Un mensaje (o varios si no entran en WHATSAPP_MAX_CARACTERES) con todas
+    las solicitudes, cada una armada con formatear_mensaje_whatsapp_solicitud.
+    Devuelve [(mensaje, solicitudes que lleva), ...].
+    """
+    bloques = [
+        formatear_mensaje_whatsapp_solicitud(s["solicitante"], json.loads(s["items"]), hora=s["hora"], pie=False)
+        for s in solicitudes
+    ]
+    largo_titulo = len("🗂 *RESUMEN: 000 SOLICITUDES NUEVAS* (00/00)")  # el más largo, para partir
+    pie = "✅ Ingresar a la bandeja para atender."
+    separador = "\n\n────────────\n\n"
+
+    mensajes, actual, incluidas = [], [], []
+    for solicitud, bloque in zip(solicitudes, bloques):
+        if actual and len(separador.join(actual + [bloque])) + largo_titulo + len(pie) > WHATSAPP_MAX_CARACTERES:
+            mensajes.append((actual, incluidas))
+            actual, incluidas = [], []
+        actual.append(bloque)
+        incluidas.append(solicitud)
+    mensajes.append((actual, incluidas))
+
+    salida = []
+    for i, (m, incluidas) in enumerate(mensajes, start=1):
+        n = len(incluidas)
+        titulo = f"🗂 *RESUMEN: {n} {'SOLICITUD NUEVA' if n == 1 else 'SOLICITUDES NUEVAS'}*"
+        if len(mensajes) > 1:
+            titulo += f" ({i}/{len(mensajes)})"
+        salida.append((f"{titulo}\n\n{separador.join(m)}\n\n{pie}", incluidas))
+    return salida
+
+
+def enviar_resumen_whatsapp(forzar=True):
+    """
+    Encola el resumen de las solicitudes en espera. Sin forzar, solo si ya
+    se cerró la ventana (lo llama el despachador del outbox).
+    """
+    ahora = time.time()
+    with transaccion() as con:
+        if not forzar and ahora - _meta(con, "whatsapp_ultimo_envio") < WHATSAPP_RESUMEN_SEG:
+            return 0
+        filas = con.execute("SELECT * FROM whatsapp_resumen WHERE enviado IS NULL ORDER BY id").fetchall()
+        if not filas:
+            return 0
+        con.execute("UPDATE whatsapp_resumen SET enviado = ? WHERE enviado IS NULL AND id <= ?",
+                    (ahora, filas[-1]["id"]))
+        _set_meta(con, "whatsapp_ultimo_envio", ahora)
+
+    tos = get_whatsapp_tos()
+    for mensaje, incluidas in formatear_resumen_whatsapp(filas):
+        encolar_whatsapp(tos, mensaje, resumen_de=[f["id_solicitud"] for f in incluidas if f["id_solicitud"]])
+    log_evento("whatsapp_resumen", solicitudes=len(filas), items=sum(f["n_items"] for f in filas))
+    return len(filas)
+
+
+def encolar_whatsapp(tos: list, mensaje: str, id_solicitud: str = "", resumen_de: list = ()):
+    """
+    Un envío por destinatario. Un resumen lleva varias solicitudes: van en
+    `resumen_de` (una fila de whatsapp_solicitudes por envío y solicitud).
+    """
+    ahora = time.time()
+    with transaccion() as con:
+        for numero in tos:
+            cur = con.execute(
+                "INSERT INTO outbox_whatsapp (id_solicitud, destinatario, mensaje, proximo_intento, creado)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (id_solicitud, numero, mensaje, ahora, ahora),
+            )
+            con.executemany(
+                "INSERT OR IGNORE INTO whatsapp_solicitudes (outbox_id, id_solicitud, creado) VALUES (?, ?, ?)",
+                [(cur.lastrowid, id_s, ahora) for id_s in resumen_de],
+            )
+
+    iniciar_outbox()
+    _outbox_estado["despertar"].set()
+
+
+def iniciar_outbox():
+    """Arranca (una vez por proceso) el hilo despachador del outbox."""
+    pid = os.getpid()
+    if _outbox_estado["pid"] == pid:
+        return
+
+    with _outbox_lock:
+        if _outbox_estado["pid"] == pid:
+            return
+        _outbox_estado["despertar"] = threading.Event()
+        _outbox_estado["session"] = None
+        threading.Thread(target=_despachar_outbox, name="outbox-whatsapp", daemon=True).start()
+        _outbox_estado["pid"] = pid
+
+
+def _wa_session():
+    sess = _outbox_estado["session"]
+    if sess is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        sess = requests.Session()
+        adapter = HTTPAdapter(pool_connections=WHATSAPP_HILOS, pool_maxsize=WHATSAPP_HILOS)
+        sess.mount("https://", adapter)
+        sess.mount("http://", adapter)
+        sess.headers.update({
+            "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+            "Content-Type": "application/json"
+        })
+        _outbox_estado["session"] = sess
+    return sess
+
+
+def _tomar_pendientes(limite):
+    """Reserva envíos vencidos (o con el lease expirado) para este proceso."""
+    ahora = time.time()
+    with transaccion() as con:
+        filas = con.execute(
+            "SELECT * FROM outbox_whatsapp"
+            " WHERE estado IN ('PENDIENTE', 'ENVIANDO') AND proximo_intento <= ?"
+            " ORDER BY proximo_intento LIMIT ?",
+            (ahora, limite),
+        ).fetchall()
+        con.executemany(
+            "UPDATE outbox_whatsapp SET estado = 'ENVIANDO', proximo_intento = ?, actualizado = ? WHERE id = ?",
+            [(ahora + OUTBOX_LEASE_SEG, ahora, f["id"]) for f in filas],
+        )
+    return filas
+
+
+def _despachar_outbox():
+    despertar = _outbox_estado["despertar"]
+    ultima_purga = 0.0
+    with ThreadPoolExecutor(max_workers=WHATSAPP_HILOS, thread_name_prefix="whatsapp") as pool:
+        while True:
+            try:
+                if time.time() - ultima_purga > 3600:
+                    limite = time.time() - OUTBOX_RETENCION_DIAS * 86400
+                    get_db().execute(
+                        "DELETE FROM outbox_whatsapp WHERE estado = 'ENVIADO' AND actualizado < ?", (limite,)
+                    )
+                    get_db().execute("DELETE FROM whatsapp_resumen WHERE enviado < ?", (limite,))
+                    ultima_purga = time.time()
+
+                if WHATSAPP_RESUMEN_SEG > 0:
+                    enviar_resumen_whatsapp(forzar=False)
+
+                filas = _tomar_pendientes(WHATSAPP_HILOS * 4)
+                if filas:
+                    list(pool.map(_entregar_whatsapp, filas))
+                    continue
+            except Exception as e:
+                log_evento("whatsapp_error_outbox", error=str(e))
+
+            despertar.wait(OUTBOX_POLL_SEG)
+            despertar.clear()
+
+
+def _entregar_whatsapp(fila):
+    url = f"{WHATSAPP_API_URL}/{WHATSAPP_PHONE_ID}/messages"
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": fila["destinatario"],
+        "type": "text",
+        "text": {"body": fila["mensaje"]}
+    }
+
+    status, error, message_id = None, "", None
+    inicio = time.perf_counter()
+    try:
+        r = _wa_session().post(url, json=payload, timeout=WHATSAPP_TIMEOUT)
+        status = r.status_code
+        if 200 <= status < 300:
+            try:
+                message_id = (r.json().get("messages") or [{}])[0].get("id")
+            except Exception:
+                message_id = None
+        else:
+            error = f"HTTP {status}: {r.text[:500]}"
+    except Exception as e:
+        error = str(e)
+
+    METRICAS.observar("whatsapp_envio_segundos", time.perf_counter() - inicio)
+    ahora = time.time()
+    intentos = fila["intentos"] + 1
+    con = get_db()
+
+    if status is not None and 200 <= status < 300:
+        METRICAS.contar("whatsapp_envios_total", resultado="enviado")
+        log_evento("whatsapp_enviado", destinatario=fila["destinatario"], status=status,
+                   message_id=message_id, id_solicitud=fila["id_solicitud"])
+        con.execute(
+            "UPDATE outbox_whatsapp SET estado = 'ENVIADO', intentos = ?, message_id = ?,"
+            " ultimo_error = NULL, actualizado = ? WHERE id = ?",
+            (intentos, message_id, ahora, fila["id"]),
+        )
+        if message_id:
+            # Los estados del webhook (entregado/leído) se asocian por message_id
+            con.execute(
+                "INSERT INTO whatsapp_estados (message_id, id_solicitud, destinatario, estado, actualizado)"
+                " VALUES (?, ?, ?, 'aceptado', ?)"
+                " ON CONFLICT(message_id) DO UPDATE SET id_solicitud = excluded.id_solicitud,"
+                " destinatario = excluded.destinatario",
+                (message_id, fila["id_solicitud"], fila["destinatario"], ahora),
+            )
+            con.execute("UPDATE whatsapp_solicitudes SET message_id = ? WHERE outbox_id = ?",
+                        (message_id, fila["id"]))
+        return
+
+    definitivo = status is not None and 400 <= status < 500 and status != 429
+    if definitivo or intentos >= WHATSAPP_MAX_INTENTOS:
+        METRICAS.contar("whatsapp_envios_total", resultado="muerto")
+        log_evento("whatsapp_muerto", destinatario=fila["destinatario"], intentos=intentos,
+                   error=error, id_solicitud=fila["id_solicitud"])
+        con.execute(
+            "UPDATE outbox_whatsapp SET estado = 'MUERTO', intentos = ?, ultimo_error = ?, actualizado = ? WHERE id = ?",
+            (intentos, error, ahora, fila["id"]),
+        )
+        return
+
+    espera = min(WHATSAPP_BACKOFF_BASE * 2 ** (intentos - 1), WHATSAPP_BACKOFF_MAX)
+    espera *= random.uniform(0.5, 1.0)
+    METRICAS.contar("whatsapp_envios_total", resultado="reintento")
+    log_evento("whatsapp_reintento", destinatario=fila["destinatario"], intentos=intentos,
+               espera_seg=round(espera), error=error, id_solicitud=fila["id_solicitud"])
+    con.execute(
+        "UPDATE outbox_whatsapp SET estado = 'PENDIENTE', intentos = ?, proximo_intento = ?,"
+        " ultimo_error = ?, actualizado = ? WHERE id = ?",
+        (intentos, ahora + espera, error, ahora, fila["id"]),
+    )
+
+
+def get_usuario(codigo):
+    codigo = str(codigo).strip()
+    usuario = USUARIOS.get()["por_codigo"].get(codigo)
+
+    if usuario is None:
+        # Puede ser un usuario recién agregado a la hoja
+        usuario = USUARIOS.recargar(max_edad=USUARIOS_RECARGA_MISS_SEG)["por_codigo"].get(codigo)
+
+    return dict(usuario) if usuario else None
+
+# ===============================
+# ARRANQUE (COLD START)
+# ===============================
+# Tras dormir, el host vuelve a importar app.py: el import no carga los
+# clientes de Google/WhatsApp y Catalogo/Usuarios salen de la copia local
+# (snapshots_hoja) mientras un hilo los trae de Google.
+_arranque = {"pid": None, "primera": None}
+
+
+def calentar():
+    """Precarga los snapshots locales y reporta el tiempo de arranque (una vez por proceso)."""
+    pid = os.getpid()
+    if _arranque["pid"] == pid:
+        return
+    _arranque["pid"] = pid
+
+    caches = {}
+    inicio = time.perf_counter()
+    for cache in (CATALOGO, USUARIOS):
+        t = time.perf_counter()
+        try:
+            origen = cache.precargar() or "sin copia local"
+        except Exception as e:
+            origen = f"error: {e}"
+        caches[cache.nombre_hoja] = {"origen": origen, "ms": round((time.perf_counter() - t) * 1000, 1)}
+
+    METRICAS.fijar("arranque_segundos", _FIN_IMPORT - _INICIO_IMPORT, fase="import")
+    METRICAS.fijar("arranque_segundos", time.perf_counter() - inicio, fase="snapshot")
+    log_evento("arranque", import_ms=round((_FIN_IMPORT - _INICIO_IMPORT) * 1000, 1), caches=caches)
+
+
+@app.before_request
+def arrancar_hilos():
+    calentar()
+    # Tras un reinicio, retoma los envíos que quedaron pendientes
+    iniciar_outbox()
+    USUARIOS.refrescar_en_fondo(USUARIOS_REFRESCO_SEG)
+    iniciar_archivo_automatico()
+    iniciar_webhook()
+    iniciar_escritura_stock()
+
+
+# ===============================
+# RUTAS PRINCIPALES
+# ===============================
+@app.route("/", methods=["GET"])
+def root():
+    return redirect(url_for("login"))
+
+
+@app.route("/login", methods=["GET", "POST"])
+def login():
+    if request.method == "POST":
+        # --- PERSONAL ---
+        codigo_personal = request.form.get("codigo_personal", "").strip()
+        nombre_personal = request.form.get("nombre_personal", "").strip()
+
+        # --- ALMACENERO ---
+        almacenero = request.form.get("almacenero", "").strip()
+        password = request.form.get("password", "").strip()
+
+        # ========= VALIDACIÓN =========
+
+        # Almacenero
+        if almacenero:
+            if almacenero == "EDWIN ROMERO" and password == "6982":
+                session["rol"] = "ALMACEN"
+                session["nombre"] = almacenero
+                return redirect(url_for("inicio"))
+
+            if almacenero == "EDGAR GARCIA" and password == "1234":
+                session["rol"] = "ALMACEN"
+                session["nombre"] = almacenero
+                return redirect(url_for("inicio"))
+
+            return render_template("login.html", error="Contraseña incorrecta")
+
+        # Personal (con validación desde sheet Usuarios por CODIGO)
+        if codigo_personal:
+            usuario = get_usuario(codigo_personal)
+            if usuario:
+                session["rol"] = "PERSONAL"
+                session["nombre"] = usuario["nombre"]
+                return redirect(url_for("inicio"))
+            return render_template("login.html", error="Código no registrado")
+
+        # Login por nombre sin código
+        if nombre_personal:
+            session["rol"] = "PERSONAL"
+            session["nombre"] = nombre_personal
+            return redirect(url_for("inicio"))
+
+        return render_template("login.html", error="Complete los datos de ingreso")
+
+    return render_template("login.html")
+
+
+@app.route("/inicio")
+def inicio():
+    if "nombre" not in session:
+        return redirect(url_for("login"))
+
+    # 🔑 ALMACENERO → BANDEJA
+    if session.get("rol") == "ALMACEN":
         return redirect(url_for("bandeja"))
 
+    # 👷 PERSONAL → INICIO NORMAL
+    return render_template("inicio.html")
+
+
+@app.route("/solicitar")
+def solicitar():
+    if "nombre" not in session:
+        return redirect(url_for("login"))
+    return render_template("solicitar.html", idempotency_key=uuid.uuid4().hex)
+
+
+# ===============================
+# ID DE SOLICITUD E IDEMPOTENCIA
+# ===============================
+# ID = fecha/hora de Lima (14 dígitos) + contador de 3 dígitos, asignado en
+# SQLite: es único entre workers y siempre creciente aunque lleguen varias
+# solicitudes en el mismo segundo (o el reloj retroceda).
+# Los IDs antiguos de 14 dígitos siguen ordenando bien como texto.
+IDEMPOTENCIA_RETENCION_SEG = 86400
+IDEMPOTENCIA_EN_CURSO_SEG = 120
+
+
+def nuevo_id_solicitud(con):
+    """Siguiente ID (dentro de una transacción ya abierta)."""
+    fila = con.execute("SELECT valor FROM secuencias WHERE nombre = 'id_solicitud'").fetchone()
+    if fila is not None:
+        ultimo = fila["valor"]
+    else:
+        # Base local nueva: continuar después del mayor ID que ya está en la réplica
+        mayor = con.execute(
+            "SELECT MAX(id_solicitud) FROM solicitudes WHERE LENGTH(id_solicitud) = 17"
+        ).fetchone()[0]
+        ultimo = int(mayor) if mayor and mayor.isdigit() else 0
+
+    candidato = int(datetime.now(ZoneInfo("America/Lima")).strftime("%Y%m%d%H%M%S")) * 1000
+    nuevo = max(candidato, ultimo + 1)
+    con.execute("INSERT OR REPLACE INTO secuencias (nombre, valor) VALUES ('id_solicitud', ?)", (nuevo,))
+    return str(nuevo)
+
+
+def reservar_solicitud(clave):
+    """
+    Devuelve (id_solicitud, previo). Con la misma idempotency_key se
+    devuelve el registro anterior (estado EN_CURSO o HECHO) en vez de un ID nuevo.
+    """
+    ahora = time.time()
+    with transaccion() as con:
+        if not clave:
+            return nuevo_id_solicitud(con), None
+
+        previo = con.execute("SELECT * FROM idempotencia WHERE clave = ?", (clave,)).fetchone()
+        if previo is not None and (previo["estado"] == "HECHO" or ahora - previo["creado"] < IDEMPOTENCIA_EN_CURSO_SEG):
+            return previo["id_solicitud"], previo["estado"]
+
+        con.execute("DELETE FROM idempotencia WHERE creado < ?", (ahora - IDEMPOTENCIA_RETENCION_SEG,))
+        id_solicitud = nuevo_id_solicitud(con)
+        con.execute(
+            "INSERT OR REPLACE INTO idempotencia (clave, id_solicitud, estado, creado) VALUES (?, ?, 'EN_CURSO', ?)",
+            (clave, id_solicitud, ahora),
+        )
+        return id_solicitud, None
+
+
+def cerrar_reserva(clave, ok):
+    if not clave:
+        return
+    with transaccion() as con:
+        if ok:
+            con.execute("UPDATE idempotencia SET estado = 'HECHO' WHERE clave = ?", (clave,))
+        else:
+            # Falló antes de quedar escrita: se permite reintentar con la misma clave
+            con.execute("DELETE FROM idempotencia WHERE clave = ?", (clave,))
+
+
+@app.route("/guardar_solicitud", methods=["POST"])
+def guardar_solicitud():
+    if "nombre" not in session:
+        return redirect(url_for("login"))
+
+    items_json = request.form.get("items_json", "").strip()
+
+    if not items_json:
+        flash("No hay ítems en la solicitud", "danger")
+        return redirect(url_for("solicitar"))
+
+    clave = request.form.get("idempotency_key", "").strip()[:64]
+    id_solicitud, previo = reservar_solicitud(clave)
+    if previo == "HECHO":
+        flash(f"✅ La solicitud {id_solicitud} ya estaba registrada.", "success")
+        return redirect(url_for("solicitar"))
+    if previo == "EN_CURSO":
+        flash(f"⏳ La solicitud {id_solicitud} se está registrando, espere un momento.", "info")
+        return redirect(url_for("solicitar"))
+
+    escrita = False
+    try:
+        items = json.loads(items_json)
+        ws = get_ws("Solicitudes")
+
+        # ✅ FECHA Y HORA REAL DE PERÚ
+        fecha = datetime.now(ZoneInfo("America/Lima"))
+        fecha_str = fecha.strftime("%d/%m/%Y %H:%M")
+
+        solicitante = session.get("nombre")
+
+        # ✅ armamos 1 mensaje con lista
+        lista_items = []
+        for idx, item in enumerate(items, start=1):
+            descripcion = item.get("descripcion", "")
+            cantidad = item.get("cantidad", "")
+            lista_items.append(f"✅{idx}) {descripcion} (x{cantidad})")
+
+        tipo_general = items[0].get("tipo", "")
+        descripcion_lista = "  |  ".join(lista_items)
+
+        # ✅ suma real de cantidades
+        cantidad_total = 0
+        for it in items:
+            try:
+                cantidad_total += int(str(it.get("cantidad", "0")).strip() or 0)
+            except:
+                cantidad_total += 0
+
+        # ✅ ARMAR TODAS LAS FILAS PRIMERO (1 fila por cada item)
+        filas_nuevas = []
+        for item in items:
+            tipo = item.get("tipo", "").strip()
+            descripcion = item.get("descripcion", "").strip()
+            cantidad = str(item.get("cantidad", "")).strip()
+
+            # ✅ BUSCAR EN CATALOGO: CODIGO SAP + CODIGO BARRAS + UM
+            codigo_sap, codigo_barras, um = buscar_en_catalogo(tipo, descripcion)
+
+            filas_nuevas.append([
+                id_solicitud,     # A ID_SOLICITUD
+                fecha_str,        # B FECHA
+                solicitante,      # C SOLICITANTE
+                tipo,             # D TIPO
+                codigo_sap,       # E CODIGO_SAP
+                descripcion,      # F DESCRIPCION
+                um,               # G UM
+                cantidad,         # H CANTIDAD
+                "PENDIENTE",      # I ESTADO
+                ""                # J ALMACENERO
+            ])
+
+        # ✅ GUARDAR EN GOOGLE SHEETS (toda la solicitud en UNA sola escritura)
+        generacion = generacion_filas()
+        respuesta = ws.append_rows(filas_nuevas)
+        escrita = True
+        try:
+            cerrar_reserva(clave, True)
+        except sqlite3.Error as e:
+            # Ya está en Sheets: no convertir el éxito en error por la base local
+            log_evento("idempotencia_error", id_solicitud=id_solicitud, error=str(e))
+        replica_registrar_append(respuesta, filas_nuevas, generacion)
+        resumen_registrar_solicitud(filas_nuevas)
+        stock_aplicar(id_solicitud, [(i, f[4], f[7], "PENDIENTE") for i, f in enumerate(filas_nuevas)])
+        publicar_evento("nueva", [id_solicitud])
+
+        log_evento("solicitud_registrada", id_solicitud=id_solicitud, items=len(filas_nuevas))
+
+        # ✅ ENVIAR WHATSAPP (UN SOLO MENSAJE)
+        enviar_whatsapp_solicitud(solicitante, items, id_solicitud)
+
+        flash("✅ Solicitud registrada. El almacén la atenderá en breve.", "success")
+        return redirect(url_for("solicitar"))
+
+    except Exception as e:
+        if not escrita:
+            cerrar_reserva(clave, False)
+        log_evento("guardar_solicitud_error", error=str(e), tipo_error=type(e).__name__)
+        flash(f"Error al guardar solicitud: {e}", "danger")
+        return redirect(url_for("solicitar"))
+
+
+# ===============================
+# BANDEJA AGRUPADA (FILTROS + PAGINACIÓN)
+# ===============================
+BANDEJA_PAGE_SIZE = int(os.environ.get("BANDEJA_PAGE_SIZE", "20"))
+BANDEJA_PAGE_SIZE_MAX = 100
+
+
+def _entero(valor, defecto, minimo=1, maximo=None):
+    try:
+        n = int(valor)
+    except (TypeError, ValueError):
+        return defecto
+    n = max(n, minimo)
+    return min(n, maximo) if maximo else n
+
+
+def _fecha_filtro(valor):
+    """'YYYY-MM-DD' válida o '' (se usa en SQL y en nombres de archivo)."""
+    valor = str(valor or "").strip()
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return ""
+
+
+def _leer_filtros_bandeja(args):
+    return {
+        "estado": args.get("estado", "").strip().upper(),
+        "desde": _fecha_filtro(args.get("desde")),      # YYYY-MM-DD
+        "hasta": _fecha_filtro(args.get("hasta")),      # YYYY-MM-DD (inclusive)
+        "solicitante": args.get("solicitante", "").strip(),
+        "page": _entero(args.get("page"), 1),
+        "page_size": _entero(args.get("page_size"), BANDEJA_PAGE_SIZE, maximo=BANDEJA_PAGE_SIZE_MAX),
+    }
+
+
+def _where_filtros(filtros):
+    condiciones, params = [], []
+
+    if filtros.get("estado"):
+        condiciones.append("estado = ?")
+        params.append(filtros["estado"])
+
+    if filtros.get("desde"):
+        condiciones.append("fecha_iso >= ?")
+        params.append(filtros["desde"])
+
+    if filtros.get("hasta"):
+        # fecha_iso lleva hora: '2025-01-31 18:00' < '2025-01-31~'
+        condiciones.append("fecha_iso < ?")
+        params.append(filtros["hasta"] + "~")
+
+    if filtros.get("solicitante"):
+        condiciones.append("UPPER(solicitante) LIKE ?")
+        params.append(f"%{filtros['solicitante'].upper()}%")
+
+    if filtros.get("tipo"):
+        condiciones.append("UPPER(tipo) = ?")
+        params.append(filtros["tipo"].upper())
+
+    return " AND ".join(condiciones) or "1 = 1", params
+
+
+def agrupar_solicitudes(filas, orden_ids):
+    """Agrupa filas de la réplica por ID_SOLICITUD respetando orden_ids."""
+    grupos = defaultdict(list)
+    for fila in filas:
+        # 'fila' = fila real en Google Sheets (para actualizar_estado)
+        grupos[fila["id_solicitud"]].append(fila)
+
+    vales = vales_de_solicitudes(orden_ids)
+    solicitudes_agrupadas = []
+    for id_s in orden_ids:
+        detalle = grupos.get(id_s)
+        if not detalle:
+            continue
+        cab = detalle[0]
+        solicitudes_agrupadas.append({
+            "id_solicitud": id_s,
+            "fecha": cab["fecha"],
+            "solicitante": cab["solicitante"],
+            "tipo": cab["tipo"],
+            "estado": cab["estado"],
+            "almacenero": cab["almacenero"],
+            "detalle": detalle,   # ✅ OJO: 'detalle' (NO 'items')
+            "vale": vales.get(id_s),
+        })
+    return solicitudes_agrupadas
+
+
+def consultar_bandeja(filtros):
+    """Agrupa y ordena solo la página pedida (id desc = más reciente arriba)."""
+    where, params = _where_filtros(filtros)
+    con = get_db()
+
+    total = con.execute(
+        f"SELECT COUNT(DISTINCT id_solicitud) FROM solicitudes WHERE {where}", params
+    ).fetchone()[0]
+
+    page_size = filtros["page_size"]
+    paginas = max(1, -(-total // page_size))
+    page = min(filtros["page"], paginas)
+
+    ids = [
+        f["id_solicitud"] for f in con.execute(
+            f"SELECT id_solicitud FROM solicitudes WHERE {where}"
+            " GROUP BY id_solicitud ORDER BY id_solicitud DESC LIMIT ? OFFSET ?",
+            [*params, page_size, (page - 1) * page_size],
+        )
+    ]
+
+    filas = []
+    if ids:
+        marcas = ", ".join("?" * len(ids))
+        filas = leer_solicitudes(f"id_solicitud IN ({marcas})", ids)
+
+    return {
+        "solicitudes": agrupar_solicitudes(filas, ids),
+        "total": total,
+        "page": page,
+        "paginas": paginas,
+        "page_size": page_size,
+    }
+
+
+@app.route("/bandeja")
+def bandeja():
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        if request.args.get("formato") == "json":
+            return jsonify({"error": "No autorizado"}), 403
+        return redirect(url_for("login"))
+
+    filtros = _leer_filtros_bandeja(request.args)
+
+    sincronizar_solicitudes()
+    resultado = consultar_bandeja(filtros)
+
+    if request.args.get("formato") == "json":
+        return jsonify({**resultado, "filtros": filtros})
+
+    return render_template("bandeja.html", filtros=filtros, ultimo_evento=ultimo_evento_id(), **resultado)
+
+
+@app.route("/bandeja/stream")
+def bandeja_stream():
+    """SSE con las solicitudes nuevas y los cambios de estado."""
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return jsonify({"error": "No autorizado"}), 403
+
+    # Al reconectar el navegador manda Last-Event-ID; la primera vez usamos
+    # el último evento que ya estaba reflejado en la página renderizada.
+    desde = request.headers.get("Last-Event-ID") or request.args.get("desde")
+    desde = _entero(desde, None, minimo=0) if desde else None
+
+    return Response(
+        flujo_eventos(desde),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/bandeja/tarjeta/<id_solicitud>")
+def bandeja_tarjeta(id_solicitud):
+    """Una sola tarjeta de la bandeja (desde la réplica, sin ir a Sheets)."""
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return "", 403
+
+    solicitudes = agrupar_solicitudes(leer_solicitudes("id_solicitud = ?", (id_solicitud,)), [id_solicitud])
+    if not solicitudes:
+        return "", 404
+
+    return render_template("_tarjeta_solicitud.html", sol=solicitudes[0])
+
+# ===============================
+# ACTUALIZAR ESTADO (UNO O EN LOTE)
+# ===============================
+def aplicar_cambios_estado(cambios, almacenero):
+    """
+    cambios: [{"fila": 12, "id_solicitud": "...", "estado": "ATENDIDO"}, ...]
+    Sin 'fila' se aplica a todas las filas del id_solicitud.
+    Antes de escribir se lee la columna A de esas filas (1 lectura): si la
+    fila ya no tiene el id esperado (hoja editada/archivada) se reporta
+    OBSOLETA y no se toca. Todo lo válido se escribe con 1 batch_update.
+    """
+    sincronizar_solicitudes()
+
+    resultados = []
+    pendientes = []  # (resultado, fila, id esperado)
+
+    for cambio in cambios:
+        estado = str(cambio.get("estado", "")).strip().upper()
+        id_sol = str(cambio.get("id_solicitud", "") or "").strip()
+        fila = cambio.get("fila")
+
+        if not estado or (fila in (None, "") and not id_sol):
+            resultados.append({"fila": fila, "id_solicitud": id_sol, "estado": estado, "resultado": "INVALIDA"})
+            continue
+
+        if fila in (None, ""):
+            filas_id = leer_solicitudes("id_solicitud = ?", (id_sol,))
+            if not filas_id:
+                resultados.append({"fila": None, "id_solicitud": id_sol, "estado": estado, "resultado": "NO_ENCONTRADA"})
+            for f in filas_id:
+                r = {"fila": f["fila"], "id_solicitud": id_sol, "estado": estado, "resultado": None}
+                resultados.append(r)
+                pendientes.append(r)
+            continue
+
+        try:
+            fila = int(fila)
+            if fila < 2:
+                raise ValueError
+        except (TypeError, ValueError):
+            resultados.append({"fila": fila, "id_solicitud": id_sol, "estado": estado, "resultado": "INVALIDA"})
+            continue
+
+        if not id_sol:
+            # El cliente no dijo qué vio: comparamos contra lo que tiene la réplica
+            conocida = leer_solicitudes("fila = ?", (fila,))
+            id_sol = conocida[0]["id_solicitud"] if conocida else ""
+
+        r = {"fila": fila, "id_solicitud": id_sol, "estado": estado, "resultado": None}
+        resultados.append(r)
+        pendientes.append(r)
+
+    if not pendientes:
+        return resultados
+
+    ws = get_ws("Solicitudes")
+    actuales = ids_en_hoja(ws, [r["fila"] for r in pendientes])
+
+    updates = []
+    for r, id_actual in zip(pendientes, actuales):
+        if not id_actual or id_actual != r["id_solicitud"]:
+            r["resultado"] = "OBSOLETA"
+            r["id_actual"] = id_actual
+            continue
+
+        # I ESTADO, J ALMACENERO
+        updates.append({"range": f"I{r['fila']}:J{r['fila']}", "values": [[r["estado"], almacenero]]})
+        r["resultado"] = "OK"
+
+    if updates:
+        exigir_filas_estables()
+        ws.batch_update(updates)
+
+        with transaccion() as con:
+            replica_cambiar_estados(
+                con, [(r["fila"], r["estado"], almacenero) for r in pendientes if r["resultado"] == "OK"]
+            )
+        publicar_evento("estado", [r["id_solicitud"] for r in pendientes if r["resultado"] == "OK"])
+        stock_aplicar_estados([r for r in pendientes if r["resultado"] == "OK"])
+
+    if any(r["resultado"] == "OBSOLETA" for r in pendientes):
+        invalidar_replica()
+
+    return resultados
+
+
+@app.route("/actualizar_estado", methods=["POST"])
+def actualizar_estado():
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return redirect(url_for("login"))
+
+    cambio = {
+        "fila": request.form.get("fila"),
+        "id_solicitud": request.form.get("id_solicitud", ""),
+        "estado": request.form.get("estado", ""),
+    }
+    almacenero = session.get("nombre")
+
+    try:
+        r = aplicar_cambios_estado([cambio], almacenero)[0]
+
+        if r["resultado"] == "OK":
+            flash(f"Solicitud {r['estado']}", "success")
+        elif r["resultado"] == "OBSOLETA":
+            flash("⚠️ La fila cambió en la hoja; recargue la bandeja e intente de nuevo", "warning")
+        else:
+            flash("Datos de actualización inválidos", "danger")
+
+    except Exception as e:
+        flash(f"Error al actualizar: {e}", "danger")
+
+    return redirect(url_for("bandeja"))
+
+
+@app.route("/actualizar_estado_lote", methods=["POST"])
+def actualizar_estado_lote():
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return jsonify({"error": "No autorizado"}), 403
+
+    data = request.get_json(silent=True)
+    if data is None:
+        try:
+            data = {"cambios": json.loads(request.form.get("cambios", "[]"))}
+        except ValueError:
+            data = {}
+
+    cambios = data.get("cambios") if isinstance(data, dict) else data
+    if not isinstance(cambios, list) or not cambios:
+        return jsonify({"error": "Envíe 'cambios': [{fila|id_solicitud, estado}, ...]"}), 400
+
+    try:
+        resultados = aplicar_cambios_estado(cambios, session.get("nombre"))
+    except ArchivoEnCurso as e:
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        log_evento("actualizar_estado_error", error=str(e))
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({
+        "ok": sum(1 for r in resultados if r["resultado"] == "OK"),
+        "resultados": resultados,
+    })
+
+
+# ===============================
+# GENERAR VALE (HTML IMPRIMIBLE)
+# ===============================
+# El vale ya no se escribe en la hoja compartida VALE_SALIDA: se muestra como
+# HTML listo para imprimir o guardar como PDF, con códigos de barra Code39 en
+# SVG. Dos almaceneros pueden generar vales a la vez y no hay límite de items.
+# El número y la fecha del vale van en K VALE / L FECHA_VALE de Solicitudes,
+# en el mismo batch_update que marca ATENDIDO: el vale se vuelve a armar con
+# esas filas (réplica o archivo), así sobrevive a un redeploy.
+CODE39 = {
+    "0": "000110100", "1": "100100001", "2": "001100001", "3": "101100000",
+    "4": "000110001", "5": "100110000", "6": "001110000", "7": "000100101",
+    "8": "100100100", "9": "001100100", "A": "100001001", "B": "001001001",
+    "C": "101001000", "D": "000011001", "E": "100011000", "F": "001011000",
+    "G": "000001101", "H": "100001100", "I": "001001100", "J": "000011100",
+    "K": "100000011", "L": "001000011", "M": "101000010", "N": "000010011",
+    "O": "100010010", "P": "001010010", "Q": "000000111", "R": "100000110",
+    "S": "001000110", "T": "000010110", "U": "110000001", "V": "011000001",
+    "W": "111000000", "X": "010010001", "Y": "110010000", "Z": "011010000",
+    "-": "010000101", ".": "110000100", " ": "011000100", "$": "010101000",
+    "/": "010100010", "+": "010001010", "%": "000101010", "*": "010010100",
+}  # 9 elementos por carácter (barra, espacio, ...); 1 = ancho
+
+
+def code39_svg(valor, alto=40, modulo=1.2):
+    """
+    SVG del Code39 de `valor` (acepta el formato '*123*' de Free 3 of 9).
+    Devuelve '' si tiene caracteres que Code39 no codifica.
+    """
+    texto = str(valor or "").strip().strip("*").upper()
+    if not texto or any(c not in CODE39 or c == "*" for c in texto):
+        return ""
+
+    barras, x = [], 10 * modulo  # zona de silencio
+    for c in f"*{texto}*":
+        for i, ancho in enumerate(CODE39[c]):
+            w = modulo * (3 if ancho == "1" else 1)
+            if i % 2 == 0:
+                barras.append(f'<rect x="{x:.1f}" width="{w:.1f}" height="{alto}"/>')
+            x += w
+        x += modulo  # separación entre caracteres
+    x += 9 * modulo
+
+    return Markup(
+        f'<svg xmlns="http://www.w3.org/2000/svg" class="code39" viewBox="0 0 {x:.1f} {alto}"'
+        f' width="{x:.1f}" height="{alto}" role="img" aria-label="{escape(texto)}">'
+        + "".join(barras) + "</svg>"
+    )
+
+
+def _leer_solicitud_para_vale(id_solicitud):
+    """Cabecera, items y filas reales de un ID_SOLICITUD (réplica local)."""
+    items = []
+    cabecera = None
+    filas_para_actualizar = []  # filas reales en sheet Solicitudes
+
+    for fila in leer_solicitudes("id_solicitud = ?", (id_solicitud.strip(),)):
+        if cabecera is None:
+            cabecera = {
+                "id": fila["id_solicitud"],
+                "fecha": fila["fecha"],
+                "solicitante": fila["solicitante"],
+                "tipo": fila["tipo"]
+            }
+
+        items.append(_item_vale(fila))
+        filas_para_actualizar.append(fila["fila"])
+
+    return cabecera, items, filas_para_actualizar
+
+
+def _item_vale(fila):
+    # CODIGO_BARRAS del catálogo (o '*CODIGO_SAP*' como en la plantilla)
+    _, codigo_barras, _ = buscar_en_catalogo(fila["tipo"], fila["descripcion"])
+    return {
+        "codigo_sap": fila["codigo_sap"],
+        "codigo_barras": codigo_barras or fila["codigo_sap"],
+        "descripcion": fila["descripcion"],
+        "um": fila["um"],
+        "cantidad": fila["cantidad"],
+    }
+
+
+def _datos_trabajador(nombre):
+    """CODIGO, CARGO y AREA del trabajador (Usuarios por NOMBRE o NOMBRE COMPLETO)."""
+    usuario = buscar_usuario_por_nombre(nombre) or {}
+    return {
+        "codigo": usuario.get("codigo", ""),
+        "cargo": usuario.get("cargo", ""),
+        "area": usuario.get("area", ""),
+    }
+
+
+def nuevo_numero_vale(con):
+    """
+    Siguiente número de vale (dentro de una transacción ya abierta).
+    La secuencia local se pierde con el disco en un redeploy: siempre se
+    sigue después del mayor VALE que ya está en Sheets (réplica y archivo).
+    Si la escritura a Sheets falla, el número queda como un salto.
+    """
+    fila = con.execute("SELECT valor FROM secuencias WHERE nombre = 'vale'").fetchone()
+    mayor = con.execute(
+        "SELECT MAX(v) FROM (SELECT MAX(vale) AS v FROM solicitudes"
+        " UNION ALL SELECT MAX(vale) FROM solicitudes_archivo)"
+    ).fetchone()[0]
+    nuevo = max(fila["valor"] if fila else 0, mayor or 0) + 1
+    con.execute("INSERT OR REPLACE INTO secuencias (nombre, valor) VALUES ('vale', ?)", (nuevo,))
+    return nuevo
+
+
+def _tomar_numeros_vale(vales, fecha_vale):
+    """
+    vales: [(id_solicitud, filas), ...] -> {id_solicitud: (numero, nuevo)}.
+    El número queda anotado en la réplica en la misma transacción que lo
+    asigna: un doble toque u otro almacenero (en cualquier worker) recibe el
+    vale que ya tiene la solicitud en vez de uno nuevo.
+    """
+    tomados = {}
+    with transaccion() as con:
+        for id_s, filas in vales:
+            previo = con.execute("SELECT MAX(vale) FROM solicitudes WHERE id_solicitud = ?", (id_s,)).fetchone()[0]
+            if previo:
+                tomados[id_s] = (previo, False)
+                continue
+            numero = nuevo_numero_vale(con)
+            con.executemany(
+                "UPDATE solicitudes SET vale = ?, fecha_vale = ? WHERE fila = ?",
+                [(numero, fecha_vale, f) for f in filas],
+            )
+            tomados[id_s] = (numero, True)
+    return tomados
+
+
+def _soltar_numeros_vale(numeros):
+    """La escritura a Sheets falló: el número queda como salto."""
+    with transaccion() as con:
+        con.executemany(
+            "UPDATE solicitudes SET vale = NULL, fecha_vale = NULL WHERE vale = ?", [(n,) for n in numeros]
+        )
+
+
+def _marcar_atendidas(vales, almacenero, fecha_vale):
+    """
+    vales: [(numero, filas), ...]. I ESTADO, J ALMACENERO, K VALE y
+    L FECHA_VALE de todas las filas en 1 batch_update.
+    """
+    exigir_filas_estables()
+    get_ws("Solicitudes").batch_update([
+        {"range": f"I{f}:L{f}", "values": [["ATENDIDO", almacenero, numero, fecha_vale]]}
+        for numero, filas in vales for f in filas
+    ])
+    replica_actualizar_estado([f for _, filas in vales for f in filas], "ATENDIDO", almacenero)
+
+
+def leer_vales(numeros):
+    """Vales por número (dicts listos para vale.html), en el orden pedido."""
+    if not numeros:
+        return []
+    columnas = "vale, fecha_vale, id_solicitud, solicitante, tipo, codigo_sap, descripcion, um, cantidad, almacenero"
+    marcas = ", ".join("?" * len(numeros))
+    filas = get_db().execute(
+        f"SELECT {columnas} FROM solicitudes WHERE vale IN ({marcas}) ORDER BY fila", list(numeros)
+    ).fetchall()
+    # Vales cuyas filas ya se archivaron
+    faltan = set(numeros) - {f["vale"] for f in filas}
+    if faltan:
+        filas += get_db().execute(
+            f"SELECT {columnas} FROM solicitudes_archivo WHERE vale IN ({', '.join('?' * len(faltan))})"
+            " ORDER BY id", list(faltan),
+        ).fetchall()
+
+    por_numero = {}
+    for fila in filas:
+        vale = por_numero.get(fila["vale"])
+        if vale is None:
+            vale = por_numero[fila["vale"]] = {
+                "numero": fila["vale"],
+                "id_solicitud": fila["id_solicitud"],
+                "fecha": fila["fecha_vale"],
+                "solicitante": fila["solicitante"],
+                "trabajador": _datos_trabajador(fila["solicitante"]),
+                "almacenero": fila["almacenero"],
+                "items": [],
+            }
+        vale["items"].append(_item_vale(fila))
+    return [por_numero[n] for n in numeros if n in por_numero]
+
+
+def vales_de_solicitudes(ids):
+    """ID_SOLICITUD -> número del último vale generado."""
+    if not ids:
+        return {}
+    marcas = ", ".join("?" * len(ids))
+    return {
+        f["id_solicitud"]: f["numero"] for f in get_db().execute(
+            f"SELECT id_solicitud, MAX(vale) AS numero FROM solicitudes"
+            f" WHERE id_solicitud IN ({marcas}) AND vale IS NOT NULL GROUP BY id_solicitud",
+            list(ids),
+        )
+    }
+
+
+def _generar(ids, almacenero):
+    """
+    Numera los vales de `ids` y los marca ATENDIDO (1 escritura a Sheets).
+    Devuelve [(numero, nuevo), ...]; una solicitud que ya tenía vale
+    conserva su número y no se vuelve a escribir.
+    """
+    sincronizar_solicitudes()
+    exigir_filas_estables()
+
+    previos = vales_de_solicitudes(ids)
+    vales, filas = [], []
+    for id_s in ids:
+        if id_s in previos:
+            continue
+        cabecera, items, filas_id = _leer_solicitud_para_vale(id_s)
+        if items:
+            vales.append((cabecera, items))
+            filas.append(filas_id)
+
+    tomados = {id_s: (numero, False) for id_s, numero in previos.items()}
+    if vales:
+        # Las filas salen de la réplica: si alguien borró u ordenó filas en la
+        # hoja desde la última sincronización completa, no se marca nada.
+        esperadas = [(f, cabecera["id"]) for (cabecera, _), filas_id in zip(vales, filas) for f in filas_id]
+        actuales = ids_en_hoja(get_ws("Solicitudes"), [f for f, _ in esperadas])
+        if any(actual != id_s for (_, id_s), actual in zip(esperadas, actuales)):
+            invalidar_replica()
+            raise FilasDesactualizadas("la hoja Solicitudes cambió; recargue la bandeja e intente de nuevo")
+
+        fecha_vale = datetime.now(ZoneInfo("America/Lima")).strftime("%d/%m/%Y %H:%M")
+        tomados.update(_tomar_numeros_vale([(c["id"], f) for (c, _), f in zip(vales, filas)], fecha_vale))
+        nuevos = [(c, items, f) for (c, items), f in zip(vales, filas) if tomados[c["id"]][1]]
+
+        if nuevos:
+            numeros = [tomados[c["id"]][0] for c, _, _ in nuevos]
+            try:
+                # 1 escritura: MARCAR SOLICITUDES COMO ATENDIDAS (TODAS LAS FILAS DE CADA ID) + N° DE VALE
+                _marcar_atendidas([(n, f) for n, (_, _, f) in zip(numeros, nuevos)], almacenero, fecha_vale)
+            except Exception:
+                _soltar_numeros_vale(numeros)
+                raise
+
+            for cabecera, items, _ in nuevos:
+                stock_aplicar(cabecera["id"], [(i, it["codigo_sap"], it["cantidad"], "ATENDIDO") for i, it in enumerate(items)])
+            publicar_evento("estado", [cabecera["id"] for cabecera, _, _ in nuevos])
+
+    return [tomados[id_s] for id_s in ids if id_s in tomados]
+
+
+@app.route("/generar_vale/<id_solicitud>", methods=["POST"])
+def generar_vale(id_solicitud):
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return redirect(url_for("login"))
+
+    try:
+        numeros = _generar([id_solicitud], session.get("nombre", ""))
+    except FilasDesactualizadas as e:
+        flash(f"⚠️ {e}", "warning")
+        return redirect(url_for("bandeja"))
     except Exception as e:
         flash(f"❌ Error al generar vale: {e}", "danger")
         return redirect(url_for("bandeja"))
 
+    if not numeros:
+        flash("❌ No se encontraron items para esta solicitud", "danger")
+        return redirect(url_for("bandeja"))
+
+    numero, nuevo = numeros[0]
+    if nuevo:
+        flash(f"✅ VALE {numero:06d} generado y solicitud marcada como ATENDIDO", "success")
+    else:
+        flash(f"ℹ️ La solicitud ya tenía el VALE {numero:06d}", "info")
+    return redirect(url_for("ver_vales", n=[numero]))
+
+
+@app.route("/generar_vales", methods=["POST"])
+def generar_vales():
+    """
+    Varios vales a la vez (p.ej. cierre de turno): 1 escritura a Sheets
+    sin importar cuántos, y una sola página para imprimirlos todos.
+    """
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return redirect(url_for("login"))
+
+    ids = [i.strip() for i in request.form.getlist("ids") if i.strip()]
+    ids = list(dict.fromkeys(ids))  # sin repetidos, mismo orden
+
+    if not ids:
+        flash("Seleccione al menos una solicitud", "warning")
+        return redirect(url_for("bandeja"))
+
+    try:
+        numeros = _generar(ids, session.get("nombre", ""))
+    except FilasDesactualizadas as e:
+        flash(f"⚠️ {e}", "warning")
+        return redirect(url_for("bandeja"))
+    except Exception as e:
+        flash(f"❌ Error al generar vales: {e}", "danger")
+        return redirect(url_for("bandeja"))
+
+    if not numeros:
+        flash("❌ No se encontraron items para las solicitudes seleccionadas", "danger")
+        return redirect(url_for("bandeja"))
+
+    generados = [n for n, nuevo in numeros if nuevo]
+    previos = [n for n, nuevo in numeros if not nuevo]
+    partes = []
+    if generados:
+        partes.append(f"✅ {len(generados)} vales generados ({', '.join(f'{n:06d}' for n in generados)})")
+    if previos:
+        partes.append(f"ℹ️ {len(previos)} ya tenían vale ({', '.join(f'{n:06d}' for n in previos)})")
+    flash(" · ".join(partes), "success" if generados else "info")
+    return redirect(url_for("ver_vales", n=[n for n, _ in numeros]))
+
+
+@app.route("/vales")
+def ver_vales():
+    """Vales para imprimir: /vales?n=12&n=13 (uno por página)."""
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return redirect(url_for("login"))
+
+    numeros = [n for n in (_entero(v, None) for v in request.args.getlist("n")) if n]
+    vales = leer_vales(list(dict.fromkeys(numeros)))
+    if not vales:
+        flash("❌ Vale no encontrado", "danger")
+        return redirect(url_for("bandeja"))
+
+    return render_template("vale.html", vales=vales, code39=code39_svg)
+
+
+# ===============================
+# EXPORTAR HISTORIAL (CSV / XLSX)
+# ===============================
+# Lee la réplica local más lo archivado (solicitudes_archivo) fila por fila:
+# el CSV sale en bloques mientras se recorre el cursor y el XLSX se arma en
+# un archivo temporal (openpyxl write_only), nunca entero en memoria.
+EXPORT_BLOQUE_FILAS = 500
+
+
+def _cursor_export(filtros):
+    where, params = _where_filtros(filtros)
+    columnas = ", ".join(COLUMNAS_SOLICITUDES)
+    return get_db().execute(
+        f"SELECT {columnas}, fecha_iso FROM solicitudes WHERE {where}"
+        f" UNION ALL SELECT {columnas}, fecha_iso FROM solicitudes_archivo WHERE {where}"
+        " ORDER BY fecha_iso, id_solicitud",
+        [*params, *params],
+    )
+
+
+def _csv_en_bloques(cursor):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write("\ufeff")  # BOM: Excel abre bien tildes y ñ
+    escritor.writerow([c.upper() for c in COLUMNAS_SOLICITUDES])
+
+    n = 0
+    for fila in cursor:
+        escritor.writerow([fila[c] for c in COLUMNAS_SOLICITUDES])
+        n += 1
+        if n % EXPORT_BLOQUE_FILAS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _xlsx_temporal(cursor):
+    """Escribe el XLSX en disco y devuelve la ruta."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    hoja = wb.create_sheet("Solicitudes")
+    hoja.append([c.upper() for c in COLUMNAS_SOLICITUDES])
+    for fila in cursor:
+        valores = [fila[c] for c in COLUMNAS_SOLICITUDES]
+        cantidad = str(fila["cantidad"] or "").strip()
+        valores[COLUMNAS_SOLICITUDES.index("cantidad")] = int(cantidad) if cantidad.isdigit() else cantidad
+        hoja.append(valores)
+
+    fd, ruta = tempfile.mkstemp(prefix="export-", suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb.save(ruta)
+    except BaseException:
+        os.remove(ruta)
+        raise
+    return ruta
+
+
+def _leer_y_borrar(ruta, bloque=64 * 1024):
+    try:
+        with open(ruta, "rb") as f:
+            while True:
+                datos = f.read(bloque)
+                if not datos:
+                    break
+                yield datos
+    finally:
+        os.remove(ruta)
+
+
+@app.route("/export/solicitudes")
+def export_solicitudes():
+    """?formato=csv|xlsx&desde=YYYY-MM-DD&hasta=YYYY-MM-DD&estado=&tipo=&solicitante="""
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return jsonify({"error": "No autorizado"}), 403
+
+    formato = request.args.get("formato", "csv").lower()
+    if formato not in ("csv", "xlsx"):
+        return jsonify({"error": "formato debe ser csv o xlsx"}), 400
+    if formato == "xlsx" and not HAY_OPENPYXL:
+        return jsonify({"error": "XLSX no disponible en este servidor (falta openpyxl); use formato=csv"}), 501
+
+    filtros = _leer_filtros_bandeja(request.args)
+    filtros["tipo"] = request.args.get("tipo", "").strip()
+    for campo in ("desde", "hasta"):
+        if request.args.get(campo, "").strip() and not filtros[campo]:
+            return jsonify({"error": f"{campo} debe tener el formato YYYY-MM-DD"}), 400
+
+    sincronizar_solicitudes()
+    cursor = _cursor_export(filtros)
+
+    nombre = "solicitudes"
+    if filtros["desde"] or filtros["hasta"]:
+        nombre += f"_{filtros['desde'] or 'inicio'}_{filtros['hasta'] or 'hoy'}"
+    log_evento("export_solicitudes", formato=formato, filtros=filtros)
+
+    if formato == "csv":
+        return Response(
+            _csv_en_bloques(cursor),
+            mimetype="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{nombre}.csv"'},
+        )
+
+    ruta = _xlsx_temporal(cursor)
+    return Response(
+        _leer_y_borrar(ruta),
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={
+            "Content-Disposition": f'attachment; filename="{nombre}.xlsx"',
+            "Content-Length": str(os.path.getsize(ruta)),
+        },
+    )
+
+
+# ===============================
+# LIBRO DE STOCK
+# ===============================
+# Movimientos solo-agregar en SQLite, por fila (renglón) de cada solicitud:
+# PENDIENTE tiene su cantidad reservada, ATENDIDO la tiene como SALIDA y
+# RECHAZADO no tiene nada. Cada cambio de estado agrega solo la diferencia
+# (RESERVA/LIBERA, SALIDA positiva o negativa) de las filas que cambiaron.
+# Cada proceso lleva en memoria reservado/salidas por CODIGO leyendo solo
+# los movimientos nuevos. Un hilo escribe cada STOCK_ESCRITURA_SEG las
+# salidas netas en Catalogo.STOCK con 1 lectura + 1 batch_update.
+#   stock físico = STOCK de la hoja - salidas que el snapshot aún no incluye
+#   disponible   = físico - reservado
+STOCK_ESCRITURA_SEG = float(os.environ.get("STOCK_ESCRITURA_SEG", "300"))
+STOCK_PAYLOAD_SEG = float(os.environ.get("STOCK_PAYLOAD_SEG", "5"))  # recálculo máx. del JSON del catálogo
+STOCK_LEASE_SEG = 300
+
+_stock_lock = threading.Lock()
+_stock_estado = {
+    "pid": None,
+    "ultimo_id": 0,
+    "reservado": defaultdict(int),
+    "salidas": [],          # (id, codigo, cantidad) posteriores a lo ya escrito en la hoja
+    "payloads": {},         # tipo -> (snapshot, ultimo_id, calculado, payload)
+    "hilo_pid": None,
+}
+
+
+def _numero_stock(valor):
+    try:
+        n = float(str(valor).replace(",", ".").strip())
+    except (TypeError, ValueError):
+        return None
+    return int(n) if n.is_integer() else n
+
+
+def stock_escrito_hasta():
+    """Último movimiento cuyas salidas ya están en Catalogo.STOCK."""
+    return int(_meta(get_db(), "stock_escrito_hasta"))
+
+
+def _objetivo_stock(estado, cantidad):
+    """(reservado, salida) que debe tener un renglón en `estado`."""
+    if estado == "ATENDIDO":
+        return 0, cantidad
+    if estado == "RECHAZADO":
+        return 0, 0
+    return cantidad, 0
+
+
+def stock_aplicar(id_solicitud, renglones):
+    """
+    renglones: [(renglon, codigo, cantidad, estado), ...] de una solicitud.
+    Agrega los movimientos que faltan para que cada renglón quede como pide
+    su estado; los renglones que no se pasan no se tocan.
+    """
+    ahora = time.time()
+    try:
+        with transaccion() as con:
+            actuales = defaultdict(lambda: [0, 0])  # (renglon, codigo) -> [reservado, salida]
+            for f in con.execute(
+                "SELECT renglon, codigo,"
+                " SUM(CASE tipo WHEN 'RESERVA' THEN cantidad WHEN 'LIBERA' THEN -cantidad ELSE 0 END) AS reservado,"
+                " SUM(CASE tipo WHEN 'SALIDA' THEN cantidad ELSE 0 END) AS salida"
+                " FROM movimientos_stock WHERE id_solicitud = ? GROUP BY renglon, codigo",
+                (id_solicitud,),
+            ):
+                actuales[(f["renglon"], f["codigo"])] = [f["reservado"], f["salida"]]
+
+            movimientos = []
+            for renglon, codigo, cantidad, estado in renglones:
+                codigo = str(codigo or "").strip()
+                objetivo = {codigo: _objetivo_stock(estado, _cantidad(cantidad))} if codigo else {}
+                # Incluye códigos que el renglón tuvo antes (p.ej. si se corrigió en la hoja)
+                codigos = set(objetivo) | {c for r, c in actuales if r == renglon}
+                for c in codigos:
+                    reservado, salida = objetivo.get(c, (0, 0))
+                    delta_reserva = reservado - actuales[(renglon, c)][0]
+                    delta_salida = salida - actuales[(renglon, c)][1]
+                    if delta_reserva:
+                        movimientos.append((c, "RESERVA" if delta_reserva > 0 else "LIBERA", abs(delta_reserva), renglon))
+                    if delta_salida:
+                        movimientos.append((c, "SALIDA", delta_salida, renglon))
+
+            con.executemany(
+                "INSERT INTO movimientos_stock (codigo, tipo, cantidad, id_solicitud, renglon, creado)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(c, tipo, n, id_solicitud, renglon, ahora) for c, tipo, n, renglon in movimientos],
+            )
+    except sqlite3.Error as e:
+        log_evento("stock_error", id_solicitud=id_solicitud, error=str(e))
+
+
+def stock_aplicar_estados(cambios):
+    """Cambios de estado por fila (actualizar_estado): solo esos renglones."""
+    por_id = defaultdict(dict)
+    for r in cambios:
+        por_id[r["id_solicitud"]][r["fila"]] = r["estado"]
+
+    for id_solicitud, estados in por_id.items():
+        filas = leer_solicitudes("id_solicitud = ?", (id_solicitud,))
+        stock_aplicar(id_solicitud, [
+            (renglon, f["codigo_sap"], f["cantidad"], estados[f["fila"]])
+            for renglon, f in enumerate(filas) if f["fila"] in estados
+        ])
+
+
+def _stock_al_dia():
+    """Incorpora a la memoria del proceso los movimientos nuevos del libro."""
+    pid = os.getpid()
+    con = get_db()
+    with _stock_lock:
+        if _stock_estado["pid"] != pid:
+            # Proceso nuevo: reservas agregadas y salidas aún no escritas
+            base = stock_escrito_hasta()
+            _stock_estado["reservado"] = defaultdict(int, {
+                f["codigo"]: f["n"] for f in con.execute(
+                    "SELECT codigo, SUM(CASE tipo WHEN 'RESERVA' THEN cantidad ELSE -cantidad END) AS n"
+                    " FROM movimientos_stock WHERE tipo IN ('RESERVA', 'LIBERA') GROUP BY codigo"
+                )
+            })
+            _stock_estado["salidas"] = [
+                (f["id"], f["codigo"], f["cantidad"]) for f in con.execute(
+                    "SELECT id, codigo, cantidad FROM movimientos_stock WHERE tipo = 'SALIDA' AND id > ?", (base,)
+                )
+            ]
+            _stock_estado["ultimo_id"] = con.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM movimientos_stock"
+            ).fetchone()[0]
+            _stock_estado["payloads"] = {}
+            _stock_estado["pid"] = pid
+            return
+
+        for f in con.execute(
+            "SELECT id, codigo, tipo, cantidad FROM movimientos_stock WHERE id > ? ORDER BY id",
+            (_stock_estado["ultimo_id"],),
+        ):
+            if f["tipo"] == "SALIDA":
+                _stock_estado["salidas"].append((f["id"], f["codigo"], f["cantidad"]))
+            else:
+                _stock_estado["reservado"][f["codigo"]] += f["cantidad"] if f["tipo"] == "RESERVA" else -f["cantidad"]
+            _stock_estado["ultimo_id"] = f["id"]
+
+
+def _salidas_sin_reflejar(datos):
+    """CODIGO -> salidas que el snapshot del catálogo todavía no tiene."""
+    desde = datos.get("stock_desde", 0)
+    salidas = defaultdict(int)
+    with _stock_lock:
+        _stock_estado["salidas"] = [s for s in _stock_estado["salidas"] if s[0] > desde]
+        for id_mov, codigo, n in _stock_estado["salidas"]:
+            if id_mov > desde:
+                salidas[codigo] += n
+    return salidas
+
+
+def _catalogo_para_stock():
+    datos = CATALOGO.get()
+    if stock_escrito_hasta() > datos.get("stock_desde", 0):
+        # Otro worker ya escribió en la hoja: este snapshot descontaría dos veces
+        CATALOGO.invalidar()
+        datos = CATALOGO.get()
+    return datos
+
+
+def stock_actual(datos=None):
+    """CODIGO -> {'stock', 'reservado', 'disponible'} solo de los códigos con movimientos."""
+    datos = datos or _catalogo_para_stock()
+    _stock_al_dia()
+    salidas = _salidas_sin_reflejar(datos)
+    with _stock_lock:
+        reservado = {c: n for c, n in _stock_estado["reservado"].items() if n}
+
+    actual = {}
+    for codigo in set(salidas) | set(reservado):
+        base = datos["stock"].get(codigo)
+        fisico = base - salidas.get(codigo, 0) if isinstance(base, (int, float)) else base
+        disponible = fisico - reservado.get(codigo, 0) if isinstance(fisico, (int, float)) else None
+        actual[codigo] = {"stock": fisico, "reservado": reservado.get(codigo, 0), "disponible": disponible}
+    return actual
+
+
+def con_stock_actual(items, actual=None):
+    """Copia de los items del catálogo con STOCK/reservado/disponible al día."""
+    actual = stock_actual() if actual is None else actual
+    salida = []
+    for it in items:
+        mov = actual.get(str(it.get("codigo_sap", "")).strip())
+        salida.append({**it, **mov} if mov else it)
+    return salida
+
+
+def payload_catalogo(tipo):
+    """
+    JSON precalculado de /api/catalogo con el stock al día. Solo se recalcula
+    si hubo movimientos desde el último cálculo (y como mucho cada STOCK_PAYLOAD_SEG).
+    """
+    datos = _catalogo_para_stock()
+    payloads = datos["payloads"]
+    tipo = tipo if tipo in payloads else ""
+    if tipo == "":
+        return payloads[""]
+
+    _stock_al_dia()
+    ultimo = _stock_estado["ultimo_id"]
+    previo = _stock_estado["payloads"].get(tipo)
+    if previo and previo[0] is datos and (previo[1] == ultimo or time.time() - previo[2] < STOCK_PAYLOAD_SEG):
+        return previo[3]
+
+    actual = stock_actual(datos)
+    items = datos["por_tipo"][tipo]
+    if not any(str(it.get("codigo_sap", "")).strip() in actual for it in items):
+        payload = payloads[tipo]
+    else:
+        payload = _precomputar_payload(con_stock_actual(items, actual))
+    _stock_estado["payloads"][tipo] = (datos, ultimo, time.time(), payload)
+    return payload
+
+
+def escribir_stock():
+    """
+    Escribe en Catalogo.STOCK las salidas pendientes (1 lectura + 1 batch_update).
+    Devuelve cuántos códigos se actualizaron, o None si otro proceso lo está haciendo.
+    """
+    ahora = time.time()
+    with transaccion() as con:
+        if _meta(con, "stock_lease") > ahora:
+            return None
+        desde = int(_meta(con, "stock_escrito_hasta"))
+        hasta = con.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM movimientos_stock WHERE tipo = 'SALIDA'"
+        ).fetchone()[0]
+        if hasta <= desde:
+            return 0
+        _set_meta(con, "stock_lease", ahora + STOCK_LEASE_SEG)
+
+    from gspread.utils import rowcol_to_a1
+
+    try:
+        netas = {
+            f["codigo"]: f["n"] for f in get_db().execute(
+                "SELECT codigo, SUM(cantidad) AS n FROM movimientos_stock"
+                " WHERE tipo = 'SALIDA' AND id > ? AND id <= ? GROUP BY codigo",
+                (desde, hasta),
+            )
+        }
+
+        ws = get_ws("Catalogo")
+        filas = ws.get_all_values()
+        cabecera = [_norm(c) for c in (filas[0] if filas else [])]
+        if "CODIGO" not in cabecera or "STOCK" not in cabecera:
+            raise RuntimeError("Catalogo no tiene columnas CODIGO y STOCK")
+        col_codigo, col_stock = cabecera.index("CODIGO"), cabecera.index("STOCK")
+        letra = rowcol_to_a1(1, col_stock + 1).rstrip("1")
+
+        updates, vistos, sin_numero = [], set(), []
+        for n, fila in enumerate(filas[1:], start=2):
+            codigo = str(fila[col_codigo] if col_codigo < len(fila) else "").strip()
+            if codigo not in netas or codigo in vistos:
+                continue
+            vistos.add(codigo)
+            actual = _numero_stock(fila[col_stock] if col_stock < len(fila) else "")
+            if actual is None:
+                sin_numero.append(codigo)
+                continue
+            updates.append({"range": f"{letra}{n}", "values": [[actual - netas[codigo]]]})
+
+        if updates:
+            ws.batch_update(updates)
+
+        with transaccion() as con:
+            _set_meta(con, "stock_escrito_hasta", hasta)
+    finally:
+        with transaccion() as con:
+            _set_meta(con, "stock_lease", 0.0)
+
+    CATALOGO.invalidar()
+    METRICAS.contar("stock_escrituras_total", len(updates))
+    log_evento("stock_escrito", codigos=len(updates), hasta=hasta,
+               sin_fila=sorted(set(netas) - vistos), sin_numero=sin_numero)
+    return len(updates)
+
+
+def iniciar_escritura_stock():
+    pid = os.getpid()
+    if STOCK_ESCRITURA_SEG <= 0 or _stock_estado["hilo_pid"] == pid:
+        return
+    with _stock_lock:
+        if _stock_estado["hilo_pid"] == pid:
+            return
+        _stock_estado["hilo_pid"] = pid
+    threading.Thread(target=_escribir_stock_periodicamente, name="stock-catalogo", daemon=True).start()
+
+
+def _escribir_stock_periodicamente():
+    while True:
+        time.sleep(STOCK_ESCRITURA_SEG * random.uniform(0.9, 1.1))
+        try:
+            escribir_stock()
+        except Exception as e:
+            log_evento("stock_error", error=str(e), tipo_error=type(e).__name__)
+
+
+@app.cli.command("escribir-stock")
+def cli_escribir_stock():
+    """Escribe ya en Catalogo.STOCK las salidas pendientes del libro de stock."""
+    n = escribir_stock()
+    click.echo("Otro proceso está escribiendo el stock." if n is None else f"{n} códigos actualizados.")
+
+
+# ===============================
+# RESÚMENES DE CONSUMO
+# ===============================
+# Totales por item, por solicitante (y su área) y por día, mantenidos en
+# SQLite al registrar solicitudes y al cambiar estados: /api/stats no
+# recorre el historial. "entregado" = cantidades en filas ATENDIDO.
+# Se reconstruyen desde la réplica + el archivo con "flask reconstruir-resumen"
+# (o solos la primera vez que se consultan).
+STATS_TOP_MAX = 100
+
+
+def _cantidad(valor):
+    """Como CAST(... AS INTEGER) de SQLite: dígitos iniciales, si no 0."""
+    m = re.match(r"\s*(\d+)", str(valor or ""))
+    return int(m.group(1)) if m else 0
+
+
+def _clave_item(codigo_sap, descripcion):
+    return str(codigo_sap or "").strip() or str(descripcion or "").strip().upper()
+
+
+def _area_de(solicitante):
+    try:
+        usuario = buscar_usuario_por_nombre(solicitante) or {}
+    except Exception:
+        usuario = {}
+    return str(usuario.get("area") or "").strip().upper() or "SIN AREA"
+
+
+def resumen_registrar_solicitud(filas):
+    """filas: las que se agregaron a Solicitudes (A..J) de una misma solicitud."""
+    if not filas:
+        return
+    solicitante = filas[0][2]
+    area = _area_de(solicitante)
+    dia = _fecha_iso(filas[0][1])[:10]
+    unidades = sum(_cantidad(f[7]) for f in filas)
+
+    try:
+        _sumar_solicitud(filas, solicitante, area, dia, unidades)
+    except sqlite3.Error as e:
+        # La solicitud ya está en Sheets: que la próxima consulta reconstruya
+        log_evento("resumen_error", error=str(e))
+        try:
+            get_db().execute("UPDATE replica_meta SET valor = 0 WHERE clave = 'resumen_listo'")
+        except sqlite3.Error:
+            pass
+
+
+def _sumar_solicitud(filas, solicitante, area, dia, unidades):
+    with transaccion() as con:
+        con.executemany(
+            "INSERT INTO resumen_items (clave, codigo_sap, descripcion, tipo, um, solicitado, lineas)"
+            " VALUES (?, ?, ?, ?, ?, ?, 1)"
+            " ON CONFLICT(clave) DO UPDATE SET solicitado = solicitado + excluded.solicitado,"
+            " lineas = lineas + 1, descripcion = excluded.descripcion",
+            [(_clave_item(f[4], f[5]), f[4], f[5], f[3], f[6], _cantidad(f[7])) for f in filas],
+        )
+        con.execute(
+            "INSERT INTO resumen_solicitantes (solicitante, area, solicitado, solicitudes) VALUES (?, ?, ?, 1)"
+            " ON CONFLICT(solicitante) DO UPDATE SET solicitado = solicitado + excluded.solicitado,"
+            " solicitudes = solicitudes + 1",
+            (solicitante, area, unidades),
+        )
+        if dia:
+            con.execute(
+                "INSERT INTO resumen_dias (dia, solicitudes, lineas, unidades) VALUES (?, 1, ?, ?)"
+                " ON CONFLICT(dia) DO UPDATE SET solicitudes = solicitudes + 1,"
+                " lineas = lineas + excluded.lineas, unidades = unidades + excluded.unidades",
+                (dia, len(filas), unidades),
+            )
+
+
+def resumen_ajustar_entregas(con, cambios):
+    """cambios: [(fila previa de la réplica, estado nuevo)]; suma o resta lo entregado."""
+    por_item, por_solicitante = defaultdict(int), defaultdict(int)
+    for previa, estado in cambios:
+        antes = str(previa["estado"] or "").strip().upper() == "ATENDIDO"
+        despues = str(estado or "").strip().upper() == "ATENDIDO"
+        if antes == despues:
+            continue
+        delta = _cantidad(previa["cantidad"]) * (1 if despues else -1)
+        por_item[_clave_item(previa["codigo_sap"], previa["descripcion"])] += delta
+        por_solicitante[previa["solicitante"]] += delta
+
+    con.executemany(
+        "UPDATE resumen_items SET entregado = entregado + ? WHERE clave = ?",
+        [(d, k) for k, d in por_item.items() if d],
+    )
+    con.executemany(
+        "UPDATE resumen_solicitantes SET entregado = entregado + ? WHERE solicitante = ?",
+        [(d, k) for k, d in por_solicitante.items() if d],
+    )
+
+
+def reconstruir_resumen():
+    """Recalcula los tres resúmenes desde la réplica y solicitudes_archivo."""
+    sincronizar_solicitudes()
+    historial = (
+        "SELECT id_solicitud, fecha_iso, solicitante, tipo, codigo_sap, descripcion, um, cantidad, estado FROM solicitudes"
+        " UNION ALL SELECT id_solicitud, fecha_iso, solicitante, tipo, codigo_sap, descripcion, um, cantidad, estado"
+        " FROM solicitudes_archivo"
+    )
+    clave = "COALESCE(NULLIF(TRIM(codigo_sap), ''), UPPER(TRIM(descripcion)))"
+    entregado = "SUM(CASE WHEN UPPER(TRIM(estado)) = 'ATENDIDO' THEN CAST(TRIM(cantidad) AS INTEGER) ELSE 0 END)"
+
+    con = get_db()
+    solicitantes = con.execute(
+        f"SELECT solicitante, SUM(CAST(TRIM(cantidad) AS INTEGER)) AS solicitado, {entregado} AS entregado,"
+        f" COUNT(DISTINCT id_solicitud) AS solicitudes FROM ({historial}) GROUP BY solicitante"
+    ).fetchall()
+    areas = {f["solicitante"]: _area_de(f["solicitante"]) for f in solicitantes}
+
+    with transaccion() as con:
+        con.execute("DELETE FROM resumen_items")
+        con.execute("DELETE FROM resumen_solicitantes")
+        con.execute("DELETE FROM resumen_dias")
+        con.execute(
+            "INSERT INTO resumen_items (clave, codigo_sap, descripcion, tipo, um, solicitado, entregado, lineas)"
+            f" SELECT {clave}, MAX(codigo_sap), MAX(descripcion), MAX(tipo), MAX(um),"
+            f" SUM(CAST(TRIM(cantidad) AS INTEGER)), {entregado}, COUNT(*)"
+            f" FROM ({historial}) WHERE {clave} != '' GROUP BY {clave}"
+        )
+        con.executemany(
+            "INSERT INTO resumen_solicitantes (solicitante, area, solicitado, entregado, solicitudes)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [(f["solicitante"], areas[f["solicitante"]], f["solicitado"], f["entregado"], f["solicitudes"])
+             for f in solicitantes],
+        )
+        con.execute(
+            "INSERT INTO resumen_dias (dia, solicitudes, lineas, unidades)"
+            " SELECT SUBSTR(fecha_iso, 1, 10), COUNT(DISTINCT id_solicitud), COUNT(*), SUM(CAST(TRIM(cantidad) AS INTEGER))"
+            f" FROM ({historial}) WHERE fecha_iso != '' GROUP BY SUBSTR(fecha_iso, 1, 10)"
+        )
+        _set_meta(con, "resumen_listo", time.time())
+
+
+@app.cli.command("reconstruir-resumen")
+def cli_reconstruir_resumen():
+    """Recalcula los resúmenes de consumo desde todo el historial."""
+    reconstruir_resumen()
+    con = get_db()
+    click.echo(
+        f"{con.execute('SELECT COUNT(*) FROM resumen_items').fetchone()[0]} items,"
+        f" {con.execute('SELECT COUNT(*) FROM resumen_solicitantes').fetchone()[0]} solicitantes,"
+        f" {con.execute('SELECT COUNT(*) FROM resumen_dias').fetchone()[0]} días"
+    )
+
+
+@app.route("/api/stats")
+def api_stats():
+    """?top=10&dias=30 → items más pedidos, consumo por área/solicitante y volumen diario."""
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return jsonify({"error": "No autorizado"}), 403
+
+    top = _entero(request.args.get("top"), 10, maximo=STATS_TOP_MAX)
+    dias = _entero(request.args.get("dias"), 30, maximo=3660)
+
+    if not _meta(get_db(), "resumen_listo"):
+        reconstruir_resumen()
+
+    con = get_db()
+    desde = (datetime.now(ZoneInfo("America/Lima")) - timedelta(days=dias - 1)).strftime("%Y-%m-%d")
+    return jsonify({
+        "items": [dict(f) for f in con.execute(
+            "SELECT codigo_sap, descripcion, tipo, um, solicitado, entregado, lineas"
+            " FROM resumen_items ORDER BY solicitado DESC LIMIT ?", (top,)
+        )],
+        "areas": [dict(f) for f in con.execute(
+            "SELECT area, SUM(solicitado) AS solicitado, SUM(entregado) AS entregado,"
+            " SUM(solicitudes) AS solicitudes, COUNT(*) AS solicitantes"
+            " FROM resumen_solicitantes GROUP BY area ORDER BY solicitado DESC"
+        )],
+        "solicitantes": [dict(f) for f in con.execute(
+            "SELECT solicitante, area, solicitado, entregado, solicitudes"
+            " FROM resumen_solicitantes ORDER BY solicitado DESC LIMIT ?", (top,)
+        )],
+        "dias": [dict(f) for f in con.execute(
+            "SELECT dia, solicitudes, lineas, unidades FROM resumen_dias WHERE dia >= ? ORDER BY dia", (desde,)
+        )],
+    })
+
 
 # ===============================
 # API CATALOGO
@@ -594,31 +3591,112 @@ def api_catalogo():
     tipo = request.args.get("tipo", "").strip().upper()
 
     try:
-        ws = get_ws("Catalogo")
-        filas = ws.get_all_records()
+        return respuesta_precalculada(payload_catalogo(tipo))
+
+    except Exception as e:
+        log_evento("catalogo_error", error=str(e))
+        return jsonify({"items": [], "error": str(e)}), 500
 
-        items = []
-        for fila in filas:
-            activo = str(fila.get("ACTIVO", "")).strip().upper()
-            tipo_fila = str(fila.get("TIPO", "")).strip().upper()
 
-            if activo == "SI" and tipo_fila == tipo:
-                items.append({
-                    "codigo_sap": fila.get("CODIGO", ""),
-                    "tipo": fila.get("TIPO", ""),
-                    "descripcion": fila.get("DESCRIPCION", ""),
-                    "um": fila.get("U.M", ""),
-                    "stock": fila.get("STOCK", ""),
-                    "codigo_barras": fila.get("CODIGO_BARRAS", "")
-                })
+@app.route("/api/catalogo/buscar")
+def api_catalogo_buscar():
+    tipo = request.args.get("tipo", "").strip().upper()
+    q = request.args.get("q", "")
+    limite = _entero(request.args.get("limit"), 20, maximo=50)
 
-        return jsonify({"items": items})
+    try:
+        return jsonify({"items": con_stock_actual(buscar_catalogo(tipo, q, limite))})
 
     except Exception as e:
-        print("ERROR /api/catalogo:", e)
+        log_evento("catalogo_buscar_error", error=str(e))
         return jsonify({"items": [], "error": str(e)}), 500
 
 
+@app.route("/api/catalogo/refrescar", methods=["POST"])
+def api_catalogo_refrescar():
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return jsonify({"error": "No autorizado"}), 403
+
+    try:
+        datos = CATALOGO.recargar()
+        return jsonify({"ok": True, "items": len(datos["por_clave"])})
+    except Exception as e:
+        log_evento("catalogo_refrescar_error", error=str(e))
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+# ===============================
+# OUTBOX WHATSAPP (REVISIÓN)
+# ===============================
+@app.route("/api/whatsapp/outbox")
+def api_whatsapp_outbox():
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return jsonify({"error": "No autorizado"}), 403
+
+    con = get_db()
+    conteo = {
+        f["estado"]: f["n"]
+        for f in con.execute("SELECT estado, COUNT(*) AS n FROM outbox_whatsapp GROUP BY estado")
+    }
+    muertos = [
+        dict(f) for f in con.execute(
+            "SELECT id, id_solicitud, destinatario, intentos, ultimo_error, actualizado"
+            " FROM outbox_whatsapp WHERE estado = 'MUERTO' ORDER BY id DESC LIMIT 50"
+        )
+    ]
+    return jsonify({"conteo": conteo, "muertos": muertos})
+
+
+@app.route("/api/whatsapp/outbox/reintentar", methods=["POST"])
+def api_whatsapp_outbox_reintentar():
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return jsonify({"error": "No autorizado"}), 403
+
+    with transaccion() as con:
+        n = con.execute(
+            "UPDATE outbox_whatsapp SET estado = 'PENDIENTE', intentos = 0, proximo_intento = ?"
+            " WHERE estado = 'MUERTO'",
+            (time.time(),),
+        ).rowcount
+
+    iniciar_outbox()
+    _outbox_estado["despertar"].set()
+    return jsonify({"ok": True, "reencolados": n})
+
+
+@app.route("/api/whatsapp/estados")
+def api_whatsapp_estados():
+    """Entrega/lectura de las notificaciones (?id_solicitud=... o las últimas 50)."""
+    if "rol" not in session or session.get("rol") != "ALMACEN":
+        return jsonify({"error": "No autorizado"}), 403
+
+    id_solicitud = request.args.get("id_solicitud", "").strip()
+    if id_solicitud:
+        # Mensajes propios de la solicitud y resúmenes que la incluyeron
+        cursor = get_db().execute(
+            "SELECT * FROM whatsapp_estados WHERE id_solicitud = ? OR message_id IN"
+            " (SELECT message_id FROM whatsapp_solicitudes WHERE id_solicitud = ?)"
+            " ORDER BY actualizado",
+            (id_solicitud, id_solicitud),
+        )
+    else:
+        cursor = get_db().execute("SELECT * FROM whatsapp_estados ORDER BY actualizado DESC LIMIT 50")
+    return jsonify({"estados": [dict(f) for f in cursor]})
+
+
+# ===============================
+# MÉTRICAS
+# ===============================
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN:
+        enviado = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if enviado != METRICS_TOKEN and request.args.get("token") != METRICS_TOKEN:
+            return "Forbidden", 403
+
+    return Response(METRICAS.texto(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/logout")
 def logout():
     session.clear()
@@ -630,6 +3708,127 @@ def logout():
 #   URL: /webhook
 # ============================================================
 
+# El POST solo valida la firma, guarda el cuerpo crudo en SQLite y responde
+# 200; un hilo por proceso procesa la cola en lotes y deja en
+# whatsapp_estados el último estado de cada mensaje (por message_id).
+WEBHOOK_LOTE = 200
+WEBHOOK_POLL_SEG = float(os.environ.get("WEBHOOK_POLL_SEG", "2"))
+WHATSAPP_ESTADOS_RETENCION_DIAS = int(os.environ.get("WHATSAPP_ESTADOS_RETENCION_DIAS", "90"))
+
+# Los estados pueden llegar desordenados: nunca se retrocede a uno anterior
+_RANGO_ESTADO = {"aceptado": 0, "sent": 1, "delivered": 2, "read": 3, "failed": 4}
+_COLUMNA_ESTADO = {"sent": "enviado", "delivered": "entregado", "read": "leido", "failed": "fallido"}
+
+_webhook_lock = threading.Lock()
+_webhook_estado = {"pid": None, "despertar": None}
+
+
+def firma_webhook_valida(cuerpo, firma):
+    if not WHATSAPP_APP_SECRET:
+        return True
+    esperada = "sha256=" + hmac.new(WHATSAPP_APP_SECRET.encode(), cuerpo, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(esperada, firma or "")
+
+
+def iniciar_webhook():
+    """Arranca (una vez por proceso) el hilo que procesa los eventos recibidos."""
+    pid = os.getpid()
+    if _webhook_estado["pid"] == pid:
+        return
+
+    with _webhook_lock:
+        if _webhook_estado["pid"] == pid:
+            return
+        _webhook_estado["despertar"] = threading.Event()
+        threading.Thread(target=_consumir_webhook, name="webhook-whatsapp", daemon=True).start()
+        _webhook_estado["pid"] = pid
+
+
+def _estados_de_evento(data):
+    """Estados de mensajes que trae un POST de Meta (los mensajes entrantes solo se cuentan)."""
+    estados = []
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            valor = change.get("value") or {}
+            for st in valor.get("statuses") or []:
+                if st.get("id") and st.get("status") in _COLUMNA_ESTADO:
+                    estados.append(st)
+            if valor.get("messages"):
+                METRICAS.contar("webhook_eventos_total", len(valor["messages"]), tipo="mensaje")
+    return estados
+
+
+def _guardar_estado(con, st, ahora):
+    estado = st["status"]
+    try:
+        ts = float(st.get("timestamp") or ahora)
+    except (TypeError, ValueError):
+        ts = ahora
+    errores = st.get("errors") or []
+    error = "; ".join(f"{e.get('code')}: {e.get('title')}" for e in errores) or None
+    columna = _COLUMNA_ESTADO[estado]
+
+    actual = con.execute("SELECT estado FROM whatsapp_estados WHERE message_id = ?", (st["id"],)).fetchone()
+    if actual is None:
+        con.execute(
+            f"INSERT INTO whatsapp_estados (message_id, destinatario, estado, {columna}, error, actualizado)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (st["id"], st.get("recipient_id"), estado, ts, error, ahora),
+        )
+        return
+
+    nuevo = estado if _RANGO_ESTADO[estado] >= _RANGO_ESTADO.get(actual["estado"], 0) else actual["estado"]
+    con.execute(
+        f"UPDATE whatsapp_estados SET estado = ?, {columna} = COALESCE({columna}, ?),"
+        " error = COALESCE(?, error), destinatario = COALESCE(destinatario, ?), actualizado = ?"
+        " WHERE message_id = ?",
+        (nuevo, ts, error, st.get("recipient_id"), ahora, st["id"]),
+    )
+
+
+def _procesar_lote_webhook():
+    """Procesa hasta WEBHOOK_LOTE eventos en una transacción; devuelve cuántos."""
+    ahora = time.time()
+    with transaccion() as con:
+        filas = con.execute(
+            "SELECT id, cuerpo FROM webhook_eventos ORDER BY id LIMIT ?", (WEBHOOK_LOTE,)
+        ).fetchall()
+
+        for fila in filas:
+            try:
+                data = json.loads(fila["cuerpo"])
+            except ValueError:
+                METRICAS.contar("webhook_eventos_total", tipo="invalido")
+                continue
+            for st in _estados_de_evento(data if isinstance(data, dict) else {}):
+                _guardar_estado(con, st, ahora)
+                METRICAS.contar("webhook_eventos_total", tipo=st["status"])
+
+        if filas:
+            con.execute("DELETE FROM webhook_eventos WHERE id <= ?", (filas[-1]["id"],))
+    return len(filas)
+
+
+def _consumir_webhook():
+    despertar = _webhook_estado["despertar"]
+    ultima_purga = 0.0
+    while True:
+        try:
+            if time.time() - ultima_purga > 3600:
+                limite = time.time() - WHATSAPP_ESTADOS_RETENCION_DIAS * 86400
+                get_db().execute("DELETE FROM whatsapp_estados WHERE actualizado < ?", (limite,))
+                get_db().execute("DELETE FROM whatsapp_solicitudes WHERE creado < ?", (limite,))
+                ultima_purga = time.time()
+
+            if _procesar_lote_webhook() == WEBHOOK_LOTE:
+                continue  # hay más en cola
+        except Exception as e:
+            log_evento("webhook_error_consumidor", error=str(e))
+
+        despertar.wait(WEBHOOK_POLL_SEG)
+        despertar.clear()
+
+
 @app.route("/webhook", methods=["GET", "POST"])
 def webhook():
     # 1) VERIFICACION (GET) - Meta envia hub.challenge
@@ -638,28 +3837,33 @@ def webhook():
         token = request.args.get("hub.verify_token")
         challenge = request.args.get("hub.challenge")
 
-        # ✅ Tu verify token definido en Meta (Config. Webhook)
-        VERIFY_TOKEN = os.environ.get("WHATSAPP_VERIFY_TOKEN", "antamina-xylem-2026")
-
+        # ✅ Verify token definido en Meta (Config. Webhook)
         if mode == "subscribe" and token == WHATSAPP_VERIFY_TOKEN:
-            print("✅ Webhook verificado correctamente")
+            log_evento("webhook_verificado")
             return challenge, 200
         else:
-            print("❌ Webhook verificación fallida")
+            log_evento("webhook_verificacion_fallida", mode=mode)
             return "Forbidden", 403
 
-    # 2) EVENTOS (POST) - Meta enviará mensajes / estados
-    try:
-        data = request.get_json(silent=True) or {}
-        print("📩 Webhook recibido:", data)
+    # 2) EVENTOS (POST) - se encolan tal cual y se responde de inmediato
+    cuerpo = request.get_data(cache=False)
+    if not firma_webhook_valida(cuerpo, request.headers.get("X-Hub-Signature-256")):
+        METRICAS.contar("webhook_eventos_total", tipo="firma_invalida")
+        return "Forbidden", 403
 
-        # Aquí podrías procesar mensajes entrantes si luego lo necesitas.
-        # Por ahora SOLO respondemos 200 para que Meta no reintente.
-        return "EVENT_RECEIVED", 200
+    try:
+        get_db().execute("INSERT INTO webhook_eventos (cuerpo, recibido) VALUES (?, ?)", (cuerpo, time.time()))
     except Exception as e:
-        print("❌ Error webhook:", e)
+        # 500: Meta reintenta más tarde
+        log_evento("webhook_error", error=str(e))
         return "ERROR", 500
 
+    iniciar_webhook()
+    _webhook_estado["despertar"].set()
+    return "EVENT_RECEIVED", 200
+
+
+_FIN_IMPORT = time.perf_counter()
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
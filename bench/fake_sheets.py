@@ -0,0 +1,299 @@
+"""
+Spreadsheet en memoria compatible con lo que usa app.py de gspread.
+
+Permite medir la app sin Google: cada llamada suma al contador, puede
+tardar una latencia fija y respeta una cuota por minuto (responde 429 con
+gspread.exceptions.APIError, igual que la API real).
+"""
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+
+import gspread
+from gspread.utils import a1_to_rowcol, column_letter_to_index
+
+
+CABECERA_SOLICITUDES = [
+    "ID_SOLICITUD", "FECHA", "SOLICITANTE", "TIPO", "CODIGO_SAP",
+    "DESCRIPCION", "UM", "CANTIDAD", "ESTADO", "ALMACENERO",
+    "VALE", "FECHA_VALE",
+]
+CABECERA_CATALOGO = ["CODIGO", "TIPO", "DESCRIPCION", "U.M", "STOCK", "ACTIVO", "CODIGO_BARRAS"]
+CABECERA_USUARIOS = ["CODIGO", "NOMBRE", "NOMBRE COMPLETO", "CARGO", "AREA", "ROL"]
+
+
+class _RespuestaFalsa:
+    """Lo mínimo que APIError necesita de un requests.Response."""
+
+    def __init__(self, codigo, mensaje, estado):
+        self.status_code = codigo
+        self.text = mensaje
+        self._error = {"error": {"code": codigo, "message": mensaje, "status": estado}}
+
+    def json(self):
+        return self._error
+
+
+def _api_error(codigo, mensaje, estado="FAILED_PRECONDITION"):
+    return gspread.exceptions.APIError(_RespuestaFalsa(codigo, mensaje, estado))
+
+
+def _rango(a1):
+    """'A6:K15' / 'J2' / 'A15:J' -> (fila1, col1, fila2, col2); fila2 None = hasta el final."""
+    a1 = a1.split("!")[-1]
+    if ":" not in a1:
+        fila, col = a1_to_rowcol(a1)
+        return fila, col, fila, col
+
+    inicio, fin = a1.split(":")
+    m1 = re.fullmatch(r"([A-Z]+)(\d*)", inicio)
+    m2 = re.fullmatch(r"([A-Z]+)(\d*)", fin)
+    return (
+        int(m1.group(2) or 1), column_letter_to_index(m1.group(1)),
+        int(m2.group(2)) if m2.group(2) else None, column_letter_to_index(m2.group(1)),
+    )
+
+
+class FakeWorksheet:
+    def __init__(self, libro, titulo, filas, id_hoja):
+        self._libro = libro
+        self.title = titulo
+        self.id = id_hoja
+        self.filas = [[str(v) for v in f] for f in filas]
+
+    # --- utilidades internas ---
+    def _llamada(self, operacion, escritura=False):
+        self._libro._registrar(self.title, operacion, escritura)
+
+    def _poner(self, fila, col, valor):
+        while len(self.filas) < fila:
+            self.filas.append([])
+        f = self.filas[fila - 1]
+        while len(f) < col:
+            f.append("")
+        f[col - 1] = "" if valor is None else str(valor)
+
+    def _escribir(self, a1, valores):
+        fila0, col0, _, _ = _rango(a1)
+        for i, fila in enumerate(valores):
+            for j, valor in enumerate(fila):
+                self._poner(fila0 + i, col0 + j, valor)
+
+    def _leer(self, a1):
+        fila1, col1, fila2, col2 = _rango(a1)
+        if fila2 is None:
+            fila2 = len(self.filas)
+        if fila1 > max(len(self.filas), 1000):
+            raise _api_error(400, f"Range ('{self.title}'!{a1}) exceeds grid limits", "INVALID_ARGUMENT")
+        salida = [list(f[col1 - 1:col2]) for f in self.filas[fila1 - 1:fila2]]
+        while salida and not any(salida[-1]):
+            salida.pop()  # la API omite filas vacías al final
+        return salida
+
+    # --- lecturas ---
+    def get_all_values(self, **kwargs):
+        self._llamada("get_all_values")
+        ancho = max((len(f) for f in self.filas), default=0)
+        return [f + [""] * (ancho - len(f)) for f in self.filas]
+
+    def get_all_records(self, **kwargs):
+        self._llamada("get_all_records")
+        if not self.filas:
+            return []
+        cab = self.filas[0]
+        registros = []
+        for f in self.filas[1:]:
+            f = f + [""] * (len(cab) - len(f))
+            registros.append({c: _numerico(v) for c, v in zip(cab, f)})
+        return registros
+
+    def get(self, a1, **kwargs):
+        self._llamada("get")
+        return self._leer(a1)
+
+    def batch_get(self, rangos, **kwargs):
+        self._llamada("batch_get")
+        return [self._leer(a1) for a1 in rangos]
+
+    def col_values(self, col, **kwargs):
+        self._llamada("col_values")
+        return [f[col - 1] if len(f) >= col else "" for f in self.filas]
+
+    # --- escrituras ---
+    def append_row(self, valores, **kwargs):
+        return self.append_rows([valores], **kwargs)
+
+    def append_rows(self, filas, **kwargs):
+        self._llamada("append_rows", escritura=True)
+        inicio = len(self.filas) + 1
+        for f in filas:
+            self.filas.append(["" if v is None else str(v) for v in f])
+        ancho = max((len(f) for f in filas), default=1)
+        fin_col = gspread.utils.rowcol_to_a1(1, ancho).rstrip("1")
+        return {"updates": {"updatedRange": f"'{self.title}'!A{inicio}:{fin_col}{len(self.filas)}"}}
+
+    def update_cell(self, fila, col, valor):
+        self._llamada("update_cell", escritura=True)
+        self._poner(fila, col, valor)
+
+    def update(self, a1, valores=None, **kwargs):
+        self._llamada("update", escritura=True)
+        self._escribir(a1, valores)
+
+    def batch_update(self, datos, **kwargs):
+        self._llamada("batch_update", escritura=True)
+        for d in datos:
+            self._escribir(d["range"], d["values"])
+
+    def batch_clear(self, rangos):
+        self._llamada("batch_clear", escritura=True)
+        for a1 in rangos:
+            fila1, col1, fila2, col2 = _rango(a1)
+            for fila in range(fila1, min(fila2 or len(self.filas), len(self.filas)) + 1):
+                for col in range(col1, col2 + 1):
+                    if len(self.filas[fila - 1]) >= col:
+                        self.filas[fila - 1][col - 1] = ""
+
+
+def _numerico(valor):
+    """get_all_records de gspread convierte números: lo imitamos."""
+    try:
+        return int(valor)
+    except ValueError:
+        try:
+            return float(valor)
+        except ValueError:
+            return valor
+
+
+class FakeSpreadsheet:
+    """
+    latencia: segundos que tarda cada llamada.
+    cuota_lectura / cuota_escritura: llamadas por minuto (None = sin límite).
+    """
+
+    def __init__(self, hojas, latencia=0.0, cuota_lectura=None, cuota_escritura=None):
+        self._lock = threading.Lock()
+        self.latencia = latencia
+        self.cuota = {"lectura": cuota_lectura, "escritura": cuota_escritura}
+        self._ventana = {"lectura": deque(), "escritura": deque()}
+        self.contador = Counter()
+        self.rechazadas = 0
+        self.hojas = {}
+        for i, (titulo, filas) in enumerate(hojas.items()):
+            self.hojas[titulo] = FakeWorksheet(self, titulo, filas, i)
+
+    def _registrar(self, hoja, operacion, escritura=False):
+        carril = "escritura" if escritura else "lectura"
+        with self._lock:
+            ahora = time.monotonic()
+            ventana = self._ventana[carril]
+            while ventana and ahora - ventana[0] > 60:
+                ventana.popleft()
+            limite = self.cuota[carril]
+            if limite is not None and len(ventana) >= limite:
+                self.rechazadas += 1
+                raise _api_error(429, "Quota exceeded (fake)", "RESOURCE_EXHAUSTED")
+            ventana.append(ahora)
+            self.contador[(hoja, operacion)] += 1
+        if self.latencia:
+            time.sleep(self.latencia)
+
+    def total_llamadas(self):
+        with self._lock:
+            return sum(self.contador.values())
+
+    # --- API de gspread.Spreadsheet usada por la app ---
+    def worksheet(self, titulo):
+        self._registrar("*", "worksheet")
+        if titulo not in self.hojas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.hojas[titulo]
+
+    def worksheets(self, **kwargs):
+        self._registrar("*", "worksheets")
+        return list(self.hojas.values())
+
+    def batch_update(self, body):
+        self._registrar("*", "batch_update", escritura=True)
+        for req in body.get("requests", []):
+            if "addSheet" in req:
+                titulo = req["addSheet"]["properties"]["title"]
+                nuevo_id = max(ws.id for ws in self.hojas.values()) + 1
+                self.hojas[titulo] = FakeWorksheet(self, titulo, [], nuevo_id)
+            elif "deleteDimension" in req:
+                r = req["deleteDimension"]["range"]
+                hoja = next(ws for ws in self.hojas.values() if ws.id == r["sheetId"])
+                del hoja.filas[r["startIndex"]:r["endIndex"]]
+            else:
+                raise NotImplementedError(f"request no soportado por el fake: {list(req)}")
+        return {"replies": []}
+
+    def values_append(self, a1, params=None, body=None):
+        hoja = a1.rsplit("!", 1)[0]
+        hoja = hoja[1:-1].replace("''", "'") if hoja.startswith("'") else hoja
+        self._registrar(hoja, "values_append", escritura=True)
+        ws = self.hojas[hoja]
+        while ws.filas and not any(ws.filas[-1]):
+            ws.filas.pop()
+        inicio = len(ws.filas) + 1
+        ws.filas.extend([["" if v is None else str(v) for v in f] for f in body["values"]])
+        return {"updates": {"updatedRange": f"'{hoja}'!A{inicio}:J{len(ws.filas)}"}}
+
+
+# ===============================
+# DATOS DE PRUEBA
+# ===============================
+PALABRAS = [
+    "GUANTE", "CASCO", "LENTE", "ZAPATO", "TRAPO", "CINTA", "PERNO", "TUERCA",
+    "ARANDELA", "FILTRO", "MASCARILLA", "TAPON", "CHALECO", "DISCO", "BROCA",
+]
+ADJETIVOS = ["CUERO", "NITRILO", "BLANCO", "NEGRO", "INDUSTRIAL", "AISLANTE", "ACERO", "M8", "M10", "3M"]
+NOMBRES = ["JUAN", "PEDRO", "LUIS", "CARLOS", "JOSÉ", "MARÍA", "ANA", "ROSA"]
+APELLIDOS = ["PÉREZ", "GARCÍA", "QUISPE", "MAMANI", "ROMERO", "TORRES", "FLORES"]
+AREAS = ["MANTENIMIENTO", "OPERACIONES", "ELECTRICO", "TALLER"]
+
+
+def datos_prueba(filas_solicitudes, items_catalogo=2000, usuarios=300, pendientes=0.1, semilla=7):
+    """Hojas Solicitudes, Catalogo y Usuarios con datos sintéticos."""
+    rnd = random.Random(semilla)
+
+    catalogo = [CABECERA_CATALOGO]
+    for i in range(items_catalogo):
+        tipo = "EPP" if i % 2 else "CONSUMIBLE"
+        desc = f"{rnd.choice(PALABRAS)} {rnd.choice(ADJETIVOS)} {i}"
+        catalogo.append([str(100000 + i), tipo, desc, rnd.choice(["UND", "PAR", "KG"]),
+                         str(rnd.randint(0, 500)), "SI", ""])
+
+    gente = []
+    usuarios_hoja = [CABECERA_USUARIOS]
+    for i in range(usuarios):
+        nombre = f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {i}"
+        gente.append(nombre)
+        usuarios_hoja.append([str(1000 + i), nombre.split()[0], nombre, "TECNICO",
+                              rnd.choice(AREAS), "PERSONAL"])
+
+    solicitudes = [CABECERA_SOLICITUDES]
+    base = time.mktime((2024, 1, 1, 7, 0, 0, 0, 0, -1))
+    n = 0
+    paso = 365 * 86400 / max(filas_solicitudes, 1)
+    while len(solicitudes) <= filas_solicitudes:
+        ts = time.localtime(base + n * paso * 3)
+        id_sol = time.strftime("%Y%m%d%H%M%S", ts) + f"{n % 1000:03d}"
+        fecha = time.strftime("%d/%m/%Y %H:%M", ts)
+        quien = rnd.choice(gente)
+        pendiente = rnd.random() < pendientes
+        for _ in range(rnd.randint(1, 5)):
+            item = catalogo[rnd.randint(1, items_catalogo)]
+            solicitudes.append([
+                id_sol, fecha, quien, item[1], item[0], item[2], item[3],
+                str(rnd.randint(1, 10)),
+                "PENDIENTE" if pendiente else "ATENDIDO",
+                "" if pendiente else "EDWIN ROMERO",
+            ])
+        n += 1
+    del solicitudes[filas_solicitudes + 1:]
+
+    return {"Solicitudes": solicitudes, "Catalogo": catalogo, "Usuarios": usuarios_hoja}
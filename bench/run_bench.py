@@ -0,0 +1,220 @@
+"""
+Benchmark de las rutas principales contra el Sheets falso y el stub de WhatsApp.
+
+    python bench/run_bench.py                       # 1k, 10k y 100k filas
+    python bench/run_bench.py --filas 10000 --iteraciones 100 --latencia 0.05
+    python bench/run_bench.py --cuota-lectura 60 --cuota-escritura 60
+
+Por escenario informa p50/p99 (ms) y llamadas a Sheets por petición.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_sheets import FakeSpreadsheet, datos_prueba  # noqa: E402
+from stub_whatsapp import StubWhatsApp  # noqa: E402
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = min(len(ordenados) - 1, max(0, round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[k]
+
+
+def preparar_entorno(args, stub, directorio):
+    """Variables de entorno que app.py lee al importarse."""
+    os.environ.setdefault("SPREADSHEET_ID", "bench")
+    os.environ.setdefault("GOOGLE_CREDENTIALS", "{}")
+    os.environ["LOCAL_DB"] = os.path.join(directorio, "almacen.sqlite3")
+    os.environ["WHATSAPP_API_URL"] = stub.url
+    os.environ["WHATSAPP_TOKEN"] = "bench"
+    os.environ["WHATSAPP_PHONE_ID"] = "bench"
+    os.environ["WHATSAPP_TOS"] = "51900000001,51900000002"
+    # La cuota la impone el fake (si se pide); el planificador no debe frenar el bench
+    os.environ["SHEETS_CUOTA_LECTURA"] = str(args.cuota_lectura or 10**6)
+    os.environ["SHEETS_CUOTA_ESCRITURA"] = str(args.cuota_escritura or 10**6)
+    os.environ["SHEETS_BACKOFF_BASE"] = "0.2"
+
+
+def limpiar_base_local(app):
+    con = app.get_db()
+    tablas = [f["name"] for f in con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    )]
+    for tabla in tablas:
+        con.execute(f"DELETE FROM {tabla}")
+
+
+def sin_error(cliente, respuesta, status=200):
+    """
+    Las rutas de formularios responden 302 también cuando fallan (flash
+    'danger'): además del status se revisan los mensajes de la sesión.
+    """
+    with cliente.session_transaction() as s:
+        mensajes = s.pop("_flashes", [])
+    return respuesta.status_code == status and not any(cat == "danger" for cat, _ in mensajes)
+
+
+def medir(nombre, fn, iteraciones, libro):
+    """fn(i) -> True si la petición hizo lo esperado."""
+    tiempos = []
+    llamadas_antes = libro.total_llamadas()
+    errores = 0
+    for i in range(iteraciones):
+        inicio = time.perf_counter()
+        ok = fn(i)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+        if not ok:
+            errores += 1
+    llamadas = libro.total_llamadas() - llamadas_antes
+    return {
+        "escenario": nombre,
+        "n": iteraciones,
+        "p50_ms": round(percentil(tiempos, 50), 2),
+        "p99_ms": round(percentil(tiempos, 99), 2),
+        "media_ms": round(statistics.fmean(tiempos), 2) if tiempos else 0.0,
+        "sheets_por_peticion": round(llamadas / max(iteraciones, 1), 2),
+        "errores": errores,
+    }
+
+
+def correr_tamano(app, filas, args):
+    libro = FakeSpreadsheet(
+        datos_prueba(filas),
+        latencia=args.latencia,
+        cuota_lectura=args.cuota_lectura,
+        cuota_escritura=args.cuota_escritura,
+    )
+    limpiar_base_local(app)
+    app.usar_spreadsheet(libro)
+
+    catalogo = libro.hojas["Catalogo"].filas[1:]
+    rnd = random.Random(11)
+
+    personal = app.app.test_client()
+    with personal.session_transaction() as s:
+        s["rol"] = "PERSONAL"
+        s["nombre"] = "JUAN PÉREZ 1"
+
+    almacen = app.app.test_client()
+    with almacen.session_transaction() as s:
+        s["rol"] = "ALMACEN"
+        s["nombre"] = "EDWIN ROMERO"
+
+    resultados = []
+
+    # Primera bandeja: incluye la carga completa de la réplica
+    def pagina(cliente, url):
+        return lambda i: cliente.get(url).status_code == 200
+
+    resultados.append(medir("bandeja (fría)", pagina(almacen, "/bandeja"), 1, libro))
+
+    hoja_solicitudes = libro.hojas["Solicitudes"]
+
+    def guardar(i):
+        items = []
+        for item in rnd.sample(catalogo, 3):
+            items.append({"tipo": item[1], "descripcion": item[2], "cantidad": str(rnd.randint(1, 5))})
+        antes = len(hoja_solicitudes.filas)
+        r = personal.post("/guardar_solicitud", data={"items_json": json.dumps(items)})
+        return sin_error(personal, r, 302) and len(hoja_solicitudes.filas) == antes + len(items)
+
+    resultados.append(medir("guardar_solicitud", guardar, args.iteraciones, libro))
+
+    # Forzamos que cada /bandeja consulte a Google (peor caso de la sincronización)
+    app.REPLICA_SYNC_SEG = 0
+    resultados.append(medir("bandeja", pagina(almacen, "/bandeja"), args.iteraciones, libro))
+    resultados.append(medir(
+        "bandeja (json, PENDIENTE)", pagina(almacen, "/bandeja?formato=json&estado=PENDIENTE"),
+        args.iteraciones, libro,
+    ))
+    app.REPLICA_SYNC_SEG = float(os.environ.get("REPLICA_SYNC_SEG", "15"))
+
+    pendientes = [
+        f["id_solicitud"] for f in app.get_db().execute(
+            "SELECT DISTINCT id_solicitud FROM solicitudes WHERE estado = 'PENDIENTE' LIMIT ?",
+            (args.iteraciones,),
+        )
+    ]
+
+    def generar_vale(i):
+        r = almacen.post(f"/generar_vale/{pendientes[i]}")
+        if not sin_error(almacen, r, 302):
+            return False
+        estados = {f["estado"] for f in app.leer_solicitudes("id_solicitud = ?", (pendientes[i],))}
+        return estados == {"ATENDIDO"}
+
+    resultados.append(medir("generar_vale", generar_vale, min(args.iteraciones, len(pendientes)), libro))
+
+    tipos = ["EPP", "CONSUMIBLE"]
+    resultados.append(medir(
+        "api_catalogo",
+        lambda i: personal.get(f"/api/catalogo?tipo={tipos[i % 2]}").status_code == 200,
+        args.iteraciones, libro,
+    ))
+
+    return resultados, libro
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--iteraciones", type=int, default=50)
+    parser.add_argument("--latencia", type=float, default=0.0, help="segundos por llamada a Sheets")
+    parser.add_argument("--cuota-lectura", type=int, default=None, help="lecturas/min del fake")
+    parser.add_argument("--cuota-escritura", type=int, default=None, help="escrituras/min del fake")
+    parser.add_argument("--whatsapp-latencia", type=float, default=0.0)
+    parser.add_argument("--json", help="guardar resultados en este archivo")
+    parser.add_argument("--logs", action="store_true", help="mostrar los logs JSON de la app")
+    args = parser.parse_args()
+
+    stub = StubWhatsApp(latencia=args.whatsapp_latencia).iniciar()
+    directorio = tempfile.mkdtemp(prefix="bench-almacen-")
+    try:
+        preparar_entorno(args, stub, directorio)
+        correr(args, stub)
+    finally:
+        stub.detener()
+        shutil.rmtree(directorio, ignore_errors=True)
+
+
+def correr(args, stub):
+    import app  # noqa: E402  (después de preparar el entorno)
+
+    if not args.logs:
+        app.log_evento = lambda evento, **campos: None
+
+    salida = []
+    print(f"{'filas':>8}  {'escenario':<28}{'p50 ms':>10}{'p99 ms':>10}{'sheets/pet':>12}{'errores':>9}")
+    for filas in args.filas:
+        resultados, libro = correr_tamano(app, filas, args)
+        for r in resultados:
+            r["filas"] = filas
+            salida.append(r)
+            print(f"{filas:>8}  {r['escenario']:<28}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+                  f"{r['sheets_por_peticion']:>12.2f}{r['errores']:>9}")
+        if libro.rechazadas:
+            print(f"{'':>8}  (429 simulados por el fake: {libro.rechazadas})")
+
+    time.sleep(1)  # deja que el outbox termine de despachar
+    print(f"\nWhatsApp recibidos por el stub: {len(stub.recibidos)} (errores simulados: {stub.errores})")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(salida, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
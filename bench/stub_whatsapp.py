@@ -0,0 +1,85 @@
+"""
+Servidor falso de la Graph API de WhatsApp (POST /<phone_id>/messages).
+
+Uso suelto:
+    python bench/stub_whatsapp.py --puerto 8099 --latencia 0.5 --fallos 0.1
+y en la app: WHATSAPP_API_URL=http://127.0.0.1:8099
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubWhatsApp:
+    def __init__(self, latencia=0.0, fallos=0.0, puerto=0):
+        self.latencia = latencia
+        self.fallos = fallos  # proporción de respuestas 500
+        self.recibidos = []
+        self.errores = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._servidor = ThreadingHTTPServer(("127.0.0.1", puerto), self._handler())
+        self._servidor.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._servidor.server_port}"
+
+    def iniciar(self):
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self):
+        self._servidor.shutdown()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                cuerpo = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if stub.latencia:
+                    time.sleep(stub.latencia)
+
+                if random.random() < stub.fallos:
+                    with stub._lock:
+                        stub.errores += 1
+                    self._responder(500, {"error": {"message": "falla simulada"}})
+                    return
+
+                with stub._lock:
+                    stub.recibidos.append(json.loads(cuerpo or b"{}"))
+                    wamid = f"wamid.stub.{next(stub._ids)}"
+                self._responder(200, {"messaging_product": "whatsapp", "messages": [{"id": wamid}]})
+
+            def _responder(self, codigo, data):
+                salida = json.dumps(data).encode()
+                self.send_response(codigo)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(salida)))
+                self.end_headers()
+                self.wfile.write(salida)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--puerto", type=int, default=8099)
+    parser.add_argument("--latencia", type=float, default=0.0)
+    parser.add_argument("--fallos", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = StubWhatsApp(args.latencia, args.fallos, args.puerto)
+    print(f"Stub WhatsApp escuchando en {stub.url}")
+    try:
+        stub._servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,50 @@
+"""
+Configuración de gunicorn (la usa el Procfile).
+
+Por defecto cada worker es gevent: mientras una petición espera a Sheets o
+a WhatsApp, el mismo proceso atiende otras (y las conexiones /bandeja/stream
+no ocupan un worker entero). Sin gevent instalado cae a gthread.
+
+Variables:
+    WEB_CONCURRENCY          procesos (también reparte la cuota de Sheets)
+    GUNICORN_WORKER_CLASS    gevent | gthread | sync
+    GUNICORN_CONEXIONES      peticiones simultáneas por worker gevent
+    GUNICORN_HILOS           hilos por worker gthread
+    GUNICORN_TIMEOUT         segundos sin respuesta antes de reiniciar un worker
+"""
+import os
+
+try:
+    import gevent  # noqa: F401
+    _clase_defecto = "gevent"
+except ImportError:
+    _clase_defecto = "gthread"
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+# app.py divide la cuota de Sheets entre los workers: que vea el mismo número
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", _clase_defecto)
+worker_connections = int(os.environ.get("GUNICORN_CONEXIONES", "200"))
+threads = int(os.environ.get("GUNICORN_HILOS", "16")) if worker_class == "gthread" else 1
+
+# Las llamadas a Sheets esperan su turno en el planificador (cuota): el
+# timeout debe cubrir esa espera más el backoff.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Sin preload: gevent parchea la librería estándar antes de importar app.py
+# (requests, ssl, threading) y cada worker abre sus propias conexiones.
+preload_app = False
+
+accesslog = None  # app.py ya registra cada petición como JSON
+errorlog = "-"
+
+
+def post_worker_init(worker):
+    # Catalogo/Usuarios desde la copia local antes de aceptar la primera petición
+    from app import calentar
+    calentar()